@@ -0,0 +1,265 @@
+#!/bin/python
+# -*- coding:utf-8 -*-
+"""
+Benchmarks of BoxcarApi against a local stub of boxcar.io.
+
+    python benchmarks/run.py --count 2000 --latency 0.01 --output out.json
+
+Every scenario reports its throughput, the p50/p99 latency of the HTTP
+requests and the CPU time spent per notification by the client process
+(the stub runs in a process of its own). The results are written as JSON,
+pass a previous file with --baseline to print the throughput change.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import optparse
+import threading
+import subprocess
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(_HERE))
+
+import boxcargae
+
+
+_API_KEY = "xxxxxxxxxxxxxxxxxxxx"
+_API_SEC = "xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx"
+_ICON_URL = "http://xxxxx.xxxx.xx.xx.xx.xxxxxxxxx.xxx/xxxxxxxxxx.png"
+
+
+class TimingTransport(boxcargae.HttpTransport):
+    """ HttpTransport recording the latency of every request """
+
+    def __init__(self, *args, **kw):
+        boxcargae.HttpTransport.__init__(self, *args, **kw)
+        self.latencies = []
+        self._latency_lock = threading.Lock()
+
+    def fetch(self, url, payload, headers, deadline=None):
+        """ see HttpTransport.fetch """
+        _start = time.time()
+        try:
+            return boxcargae.HttpTransport.fetch(self, url, payload, headers,
+                                                 deadline)
+        finally:
+            _latency = time.time() - _start
+            self._latency_lock.acquire()
+            try:
+                self.latencies.append(_latency)
+            finally:
+                self._latency_lock.release()
+
+
+def percentile(values, percent):
+    """ the percent-th percentile of values, None if there are none """
+    if (not values):
+        return None
+    _sorted = sorted(values)
+    return _sorted[int(round(percent / 100.0 * (len(_sorted) - 1)))]
+
+
+def _status(result):
+    """ the status a call ended with """
+    if (result is True):
+        return 200
+    return result.status_code
+
+
+def _call(func, *args, **kw):
+    """ call func, returning True or the BoxcarException it raised """
+    try:
+        return func(*args, **kw)
+    except boxcargae.BoxcarException, e:
+        return e
+
+
+def bench_notify(boxcar, count, options):
+    """ sequential notify calls """
+    return [_call(boxcar.notify, "user%d@example.com" % i, "bench",
+                  "notify %d" % i) for i in xrange(count)]
+
+
+def bench_broadcast(boxcar, count, options):
+    """ sequential broadcast calls """
+    return [_call(boxcar.broadcast, "bench", "broadcast %d" % i)
+            for i in xrange(count)]
+
+
+def bench_invite(boxcar, count, options):
+    """ sequential invite calls """
+    return [_call(boxcar.invite, "user%d@example.com" % i)
+            for i in xrange(count)]
+
+
+def bench_notify_many(boxcar, count, options):
+    """ one notify_many over count recipients """
+    return [_result for (_email, _result) in boxcar.notify_many(
+        ["user%d@example.com" % i for i in xrange(count)], "bench",
+        "notify_many", window=options.window)]
+
+
+def bench_notify_stream(boxcar, count, options):
+    """ notify_stream over a generator of count notifications """
+    return [_result for (_notification, _result) in boxcar.notify_stream(
+        (("user%d@example.com" % i, "bench", "notify_stream %d" % i)
+         for i in xrange(count)), window=options.window)]
+
+
+def bench_queue(boxcar, count, options):
+    """ enqueue_notify then deliver the batches with DeliveryWorker """
+    _queue = boxcargae.MemoryQueue()
+    boxcar._queue = _queue
+    for i in xrange(count):
+        boxcar.enqueue_notify("user%d@example.com" % i, "bench",
+                              "queued %d" % i)
+    boxcar.flush()
+    _worker = boxcargae.DeliveryWorker(boxcar, max_attempts=1)
+    _results = []
+    for (_countdown, _payload) in _queue.tasks:
+        _stats = _worker.handle(_payload)
+        _results.extend([True] * _stats["sent"])
+        _results.extend([boxcargae.BoxcarException("failed")] *
+                        (_stats["retried"] + _stats["dropped"]))
+    return _results
+
+
+## The scenarios in the order they run
+SCENARIOS = [("notify", bench_notify),
+             ("broadcast", bench_broadcast),
+             ("invite", bench_invite),
+             ("notify_many", bench_notify_many),
+             ("notify_stream", bench_notify_stream),
+             ("queue", bench_queue)]
+
+
+def run_scenario(name, func, endpoint, options):
+    """
+    Run one scenario on a fresh client and connection pool
+
+    @return: dict of the measures
+    """
+    _transport = TimingTransport(max_connections=options.connections)
+    _boxcar = boxcargae.BoxcarApi(_API_KEY, _API_SEC, _ICON_URL,
+                                  transport=_transport, endpoint=endpoint)
+    _cpu = sum(os.times()[:2])
+    _start = time.time()
+    _results = func(_boxcar, options.count, options)
+    _elapsed = time.time() - _start
+    _cpu = sum(os.times()[:2]) - _cpu
+    _transport.close()
+    _statuses = {}
+    for _result in _results:
+        _key = str(_status(_result))
+        _statuses[_key] = _statuses.get(_key, 0) + 1
+    _p50 = percentile(_transport.latencies, 50)
+    _p99 = percentile(_transport.latencies, 99)
+    return {"notifications": len(_results),
+            "requests": len(_transport.latencies),
+            "seconds": _elapsed,
+            "throughput": len(_results) / _elapsed,
+            "p50_ms": _p50 is not None and _p50 * 1000 or None,
+            "p99_ms": _p99 is not None and _p99 * 1000 or None,
+            "cpu_us_per_notification": _cpu * 1e6 / max(len(_results), 1),
+            "statuses": _statuses}
+
+
+def start_stub(options):
+    """ start the stub server process, return (process, endpoint) """
+    _args = [sys.executable, os.path.join(_HERE, "stub_server.py"),
+             "--latency", str(options.latency),
+             "--jitter", str(options.jitter),
+             "--status", options.status]
+    if (options.stub_connections is not None):
+        _args += ["--max-connections", str(options.stub_connections)]
+    if (options.seed is not None):
+        _args += ["--seed", str(options.seed)]
+    _process = subprocess.Popen(_args, stdout=subprocess.PIPE)
+    _port = int(_process.stdout.readline())
+    return (_process,
+            "http://127.0.0.1:%d/devices/providers/" % _port)
+
+
+def compare(results, baseline):
+    """ print the throughput change of every scenario against baseline """
+    for (_name, _measures) in sorted(results["scenarios"].items()):
+        _old = baseline.get("scenarios", {}).get(_name)
+        if (_old is None):
+            continue
+        sys.stderr.write("%-12s %10.1f/s  %+6.1f%%\n" % (
+            _name, _measures["throughput"],
+            (_measures["throughput"] / _old["throughput"] - 1) * 100))
+
+
+def main(argv=None):
+    """ run the scenarios and write the results """
+    _parser = optparse.OptionParser(usage="%prog [options]")
+    _parser.add_option("--count", type="int", default=1000,
+                       help="notifications per scenario")
+    _parser.add_option("--scenario", action="append", default=None,
+                       help="run only this scenario, may be repeated")
+    _parser.add_option("--window", type="int", default=10,
+                       help="requests in flight for the bulk paths")
+    _parser.add_option("--connections", type="int", default=10,
+                       help="size of the client connection pool")
+    _parser.add_option("--latency", type="float", default=0.0,
+                       help="mean seconds the stub waits before answering")
+    _parser.add_option("--jitter", type="float", default=0.0)
+    _parser.add_option("--status", default="200:1",
+                       help="status mix of the stub, like 200:95,500:5")
+    _parser.add_option("--stub-connections", type="int", default=None,
+                       help="connections the stub serves at once")
+    _parser.add_option("--seed", type="int", default=None)
+    _parser.add_option("--label", default=None,
+                       help="name of this run, like a release")
+    _parser.add_option("--output", default=None,
+                       help="write the JSON results here, not to stdout")
+    _parser.add_option("--baseline", default=None,
+                       help="JSON results of a previous run to compare to")
+    (_options, _args) = _parser.parse_args(argv)
+
+    (_process, _endpoint) = start_stub(_options)
+    try:
+        _results = {"label": _options.label,
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                          time.gmtime()),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "options": dict((_key, getattr(_options, _key))
+                                    for _key in ("count", "window",
+                                                 "connections", "latency",
+                                                 "jitter", "status",
+                                                 "stub_connections",
+                                                 "seed")),
+                    "scenarios": {}}
+        for (_name, _func) in SCENARIOS:
+            if (_options.scenario and _name not in _options.scenario):
+                continue
+            _results["scenarios"][_name] = run_scenario(_name, _func,
+                                                        _endpoint, _options)
+    finally:
+        _process.terminate()
+        _process.wait()
+
+    _text = json.dumps(_results, indent=2, sort_keys=True)
+    if (_options.output):
+        _file = open(_options.output, "w")
+        try:
+            _file.write(_text + "\n")
+        finally:
+            _file.close()
+    else:
+        sys.stdout.write(_text + "\n")
+    if (_options.baseline):
+        _file = open(_options.baseline)
+        try:
+            compare(_results, json.load(_file))
+        finally:
+            _file.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+#!/bin/python
+# -*- coding:utf-8 -*-
+"""
+Local stub of the boxcar provider endpoints, for the benchmarks.
+
+Run it on its own with
+    python benchmarks/stub_server.py --latency 0.02 --status 200:95,500:5
+it prints the port it listens on, then serves until killed.
+"""
+
+import re
+import sys
+import time
+import random
+import threading
+import optparse
+import BaseHTTPServer
+import SocketServer
+
+
+## The paths of the provider api
+_PATH = re.compile(r"^/devices/providers/[^/]+/"
+                   r"notifications(/broadcast|/subscribe)?$")
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ answers the provider api with the server's latency and statuses """
+
+    protocol_version = "HTTP/1.1"
+
+    # the status line and headers are written separately,
+    # do not let Nagle hold them back
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        """ wait, then answer a status drawn from the mix """
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if (_PATH.match(self.path) is None):
+            _status = 404
+        else:
+            time.sleep(self.server.draw_latency())
+            _status = self.server.draw_status()
+        self.server.count(self.path, _status)
+        self.send_response(_status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        """ be quiet """
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded stub of boxcar.io
+
+    @ivar counts: {(path, status): number of requests}
+    """
+
+    daemon_threads = True
+
+    # Listen backlog, SocketServer's 5 refuses the connections a client
+    # pool opens at once, the kernel caps it at net.core.somaxconn
+    #     @var int
+    request_queue_size = 1024
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, statuses=None,
+                 max_connections=None, seed=None):
+        """
+        @param port: the port to listen on, 0 for any free port
+        @type port: int
+        @param latency: mean seconds spent before answering
+        @type latency: float
+        @param jitter: the latency varies uniformly by +- jitter seconds
+        @type jitter: float
+        @param statuses: {status: weight} of the answers, all 200 by default
+        @type statuses: dict
+        @param max_connections: Optional; connections served at once,
+                                further ones wait to be accepted
+        @type max_connections: int
+        @param seed: Optional; seed of the latency and status draws
+        @type seed: int
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port),
+                                           StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self._statuses = sorted((statuses or {200: 1}).items())
+        self._total = float(sum(_weight for (_status, _weight)
+                                in self._statuses))
+        self._random = random.Random(seed)
+        self._slots = None
+        if (max_connections is not None):
+            self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def draw_latency(self):
+        """ seconds to wait before answering """
+        return max(0.0, self.latency +
+                   self._random.uniform(-self.jitter, self.jitter))
+
+    def draw_status(self):
+        """ a status from the mix """
+        _point = self._random.uniform(0, self._total)
+        for (_status, _weight) in self._statuses:
+            _point -= _weight
+            if (_point <= 0):
+                return _status
+        return self._statuses[-1][0]
+
+    def count(self, path, status):
+        """ account for an answer """
+        self._lock.acquire()
+        try:
+            _key = (path, status)
+            self.counts[_key] = self.counts.get(_key, 0) + 1
+        finally:
+            self._lock.release()
+
+    def process_request(self, request, client_address):
+        """ wait for a free connection slot before serving """
+        if (self._slots is not None):
+            self._slots.acquire()
+        SocketServer.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+    def process_request_thread(self, request, client_address):
+        """ serve a connection, then free its slot """
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(
+                self, request, client_address)
+        finally:
+            if (self._slots is not None):
+                self._slots.release()
+
+    def port(self):
+        """ the port the server listens on """
+        return self.server_address[1]
+
+    def start(self):
+        """ serve on a background thread """
+        _thread = threading.Thread(target=self.serve_forever)
+        _thread.setDaemon(True)
+        _thread.start()
+
+
+def parse_statuses(text):
+    """
+    Parse a status mix like "200:95,500:5"
+
+    @return: {status: weight}
+    """
+    _statuses = {}
+    for _item in text.split(","):
+        (_status, _weight) = _item.split(":")
+        _statuses[int(_status)] = float(_weight)
+    return _statuses
+
+
+def main(argv=None):
+    """ serve until killed, printing the port first """
+    _parser = optparse.OptionParser(usage="%prog [options]")
+    _parser.add_option("--port", type="int", default=0)
+    _parser.add_option("--latency", type="float", default=0.0,
+                       help="mean seconds before answering")
+    _parser.add_option("--jitter", type="float", default=0.0,
+                       help="latency varies by +- jitter seconds")
+    _parser.add_option("--status", default="200:1",
+                       help="status mix, like 200:95,500:5")
+    _parser.add_option("--max-connections", type="int", default=None)
+    _parser.add_option("--seed", type="int", default=None)
+    (_options, _args) = _parser.parse_args(argv)
+    _server = StubServer(_options.port, _options.latency, _options.jitter,
+                         parse_statuses(_options.status),
+                         _options.max_connections, _options.seed)
+    sys.stdout.write("%d\n" % _server.port())
+    sys.stdout.flush()
+    _server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
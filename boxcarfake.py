@@ -0,0 +1,377 @@
+#!/bin/python
+# -*- coding:utf-8 -*-
+"""
+Fake boxcar.io provider endpoints, for load and resilience tests.
+
+FakeTransport is given to BoxcarApi as its transport, FakeUrlfetch
+replaces the urlfetch api used by UrlfetchTransport. Both answer after a
+latency drawn from a distribution, with statuses drawn from a mix per
+endpoint, inject timeouts and connection resets, reject the requests
+over a concurrency limit, and record the timeline of every request.
+"""
+
+## Import library functions
+import re
+import time
+import random
+import threading
+import boxcargae
+
+
+## Expose the fakes and the latency distributions for importing
+__all__ = ["FakeTransport", "FakeUrlfetch", "constant", "uniform",
+           "exponential", "normal", "Error", "DownloadError",
+           "DeadlineExceededError"]
+
+
+## The task part of the provider api urls
+_TASK = re.compile(r"/devices/providers/[^/]+/"
+                   r"(notifications(?:/broadcast|/subscribe)?)$")
+
+
+def constant(seconds):
+    """
+    @return: latency distribution of always the same seconds
+    """
+    return lambda rng: seconds
+
+
+def uniform(low, high):
+    """
+    @return: latency distribution uniform between low and high seconds
+    """
+    return lambda rng: rng.uniform(low, high)
+
+
+def exponential(mean):
+    """
+    @return: latency distribution exponential with mean seconds
+    """
+    return lambda rng: rng.expovariate(1.0 / mean)
+
+
+def normal(mean, stddev):
+    """
+    @return: latency distribution normal, cut at 0 seconds
+    """
+    return lambda rng: max(0.0, rng.gauss(mean, stddev))
+
+
+class Error(Exception):
+    """ urlfetch.Error of FakeUrlfetch """
+
+
+class DownloadError(Error):
+    """ urlfetch.DownloadError of FakeUrlfetch """
+
+
+class DeadlineExceededError(DownloadError):
+    """ urlfetch.DeadlineExceededError of FakeUrlfetch """
+
+
+class _Fault(Exception):
+    """ a request failing without a response, kind is timeout or reset """
+
+    def __init__(self, kind):
+        Exception.__init__(self, kind)
+        self.kind = kind
+
+
+class _FakeResponse(object):
+    """ response of a fake request """
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.content = ""
+        self.headers = {}
+
+
+class _FakeBoxcar(object):
+    """
+    The scripted server shared by FakeTransport and FakeUrlfetch
+
+    @ivar timeline: list of the requests, dicts of "task", "start",
+                    "end" (seconds since the fake was made), "status"
+                    (None on a fault), "fault", "deadline", "in_flight"
+    """
+
+    # Seconds a request may take when the caller gives no deadline
+    #     @var float
+    DEFAULT_DEADLINE = 5.0
+
+    # Number of threads playing the asynchronous requests
+    #     @var int
+    WORKERS = 100
+
+    def __init__(self, latency=0.0, statuses=None, endpoint_statuses=None,
+                 errors=None, max_concurrency=None, overload_status=503,
+                 seed=None):
+        """
+        @param latency: Optional; seconds each request takes, or a
+                        distribution like uniform(0.01, 0.05)
+        @type latency: float or function(random.Random) -> float
+        @param statuses: Optional; the status mix of every endpoint,
+                         {status: weight}, 200 only by default
+        @type statuses: dict
+        @param endpoint_statuses: Optional; {task: {status: weight}}
+                                  overriding statuses for a task, e.g.
+                                  "notifications/subscribe"
+        @type endpoint_statuses: dict
+        @param errors: Optional; {"timeout" or "reset": rate} of the
+                       requests failing without a response
+        @type errors: dict
+        @param max_concurrency: Optional; requests in flight at once,
+                                the ones over it are answered at once
+                                with overload_status
+        @type max_concurrency: int
+        @param overload_status: the status of the requests over the limit
+        @type overload_status: int
+        @param seed: Optional; seed of the random draws
+        @type seed: int
+        """
+        if (not callable(latency)):
+            latency = constant(latency)
+        self._latency = latency
+        self._statuses = self._mix(statuses or {200: 1})
+        self._endpoint_statuses = dict(
+            (_task, self._mix(_mix))
+            for (_task, _mix) in (endpoint_statuses or {}).iteritems())
+        self._errors = dict(errors or {})
+        self.max_concurrency = max_concurrency
+        self.overload_status = overload_status
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._scripts = {}
+        self._in_flight = 0
+        self._epoch = time.time()
+        self.timeline = []
+        self._workers = boxcargae._WorkerPool(self.WORKERS)
+
+    def script(self, task, *outcomes):
+        """
+        Answer the next requests of a task with outcomes, in turn,
+        before drawing from the mix again
+
+        @param task: the task, e.g. "notifications"
+        @type task: str
+        @param outcomes: statuses, or "timeout" / "reset" for faults
+        """
+        self._lock.acquire()
+        try:
+            self._scripts.setdefault(task, []).extend(outcomes)
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        """ forget the timeline and the scripts """
+        self._lock.acquire()
+        try:
+            self._scripts = {}
+            self.timeline = []
+            self._epoch = time.time()
+        finally:
+            self._lock.release()
+
+    def summary(self):
+        """
+        The timeline summed up per task
+
+        @return: {task: {"requests", "statuses", "faults",
+                         "max_in_flight", "latency_max"}}
+        """
+        self._lock.acquire()
+        try:
+            _timeline = list(self.timeline)
+        finally:
+            self._lock.release()
+        _result = {}
+        for _entry in _timeline:
+            _task = _result.setdefault(_entry["task"],
+                                       {"requests": 0, "statuses": {},
+                                        "faults": {}, "max_in_flight": 0,
+                                        "latency_max": 0.0})
+            _task["requests"] += 1
+            if (_entry["fault"] is None):
+                _task["statuses"][_entry["status"]] = (
+                    _task["statuses"].get(_entry["status"], 0) + 1)
+            else:
+                _task["faults"][_entry["fault"]] = (
+                    _task["faults"].get(_entry["fault"], 0) + 1)
+            _task["max_in_flight"] = max(_task["max_in_flight"],
+                                         _entry["in_flight"])
+            # requests still in flight have no end yet
+            _task["latency_max"] = max(_task["latency_max"],
+                                       _entry.get("end", _entry["start"]) -
+                                       _entry["start"])
+        return _result
+
+    def _serve(self, url, deadline):
+        """
+        Play one request
+
+        @return: the status
+        @raise _Fault: on a timeout or reset
+        """
+        _match = _TASK.search(url)
+        _task = _match and _match.group(1) or url
+        if (deadline is None):
+            deadline = self.DEFAULT_DEADLINE
+        self._lock.acquire()
+        try:
+            _entry = {"task": _task, "start": time.time() - self._epoch,
+                      "deadline": deadline, "status": None, "fault": None,
+                      "in_flight": self._in_flight + 1}
+            self.timeline.append(_entry)
+            if ((self.max_concurrency is not None) and
+                    (self._in_flight >= self.max_concurrency)):
+                # rejected at once, without taking a slot
+                _entry["in_flight"] = self._in_flight
+                _entry["status"] = self.overload_status
+                _entry["end"] = _entry["start"]
+                return self.overload_status
+            if (_match is None):
+                (_outcome, _latency) = (404, 0.0)
+            else:
+                _outcome = self._draw(_task)
+                _latency = self._latency(self._random)
+            self._in_flight += 1
+        finally:
+            self._lock.release()
+        try:
+            if ((_outcome == "timeout") or (_latency > deadline)):
+                time.sleep(deadline)
+                _entry["fault"] = "timeout"
+            elif (_outcome == "reset"):
+                time.sleep(_latency / 2)
+                _entry["fault"] = "reset"
+            else:
+                time.sleep(_latency)
+                _entry["status"] = _outcome
+        finally:
+            self._lock.acquire()
+            try:
+                self._in_flight -= 1
+                _entry["end"] = time.time() - self._epoch
+            finally:
+                self._lock.release()
+        if (_entry["fault"] is not None):
+            raise _Fault(_entry["fault"])
+        return _outcome
+
+    def _draw(self, task):
+        """ the scripted or random outcome of a request, the lock is held """
+        _script = self._scripts.get(task)
+        if (_script):
+            return _script.pop(0)
+        _draw = self._random.random()
+        for (_kind, _rate) in self._errors.iteritems():
+            if (_draw < _rate):
+                return _kind
+            _draw -= _rate
+        _statuses = self._endpoint_statuses.get(task, self._statuses)
+        _draw = self._random.random()
+        for (_status, _weight) in _statuses:
+            if (_draw < _weight):
+                return _status
+            _draw -= _weight
+        return _statuses[-1][0]
+
+    def _mix(self, mix):
+        """ {status: weight} as a list of (status, share) """
+        _total = float(sum(mix.itervalues()))
+        return [(_status, mix[_status] / _total) for _status in sorted(mix)]
+
+
+class FakeTransport(_FakeBoxcar):
+    """
+    Transport answering like boxcar.io without the network, see BoxcarApi
+
+    Faults raise BoxcarTransportError, as a real transport does.
+    """
+
+    def fetch(self, url, payload, headers, deadline=None):
+        """
+        Play a request, see HttpTransport.fetch
+
+        @return: the response
+        """
+        try:
+            return _FakeResponse(self._serve(url, deadline))
+        except _Fault, e:
+            raise boxcargae.BoxcarTransportError("Fetch failed: %s" % e.kind)
+
+    def fetch_async(self, url, payload, headers, deadline=None):
+        """
+        Play a request on a thread, see HttpTransport.fetch_async
+
+        @return: the pending request, call get_result() on it for the response
+        """
+        return self._workers.submit(self.fetch, url, payload, headers,
+                                    deadline)
+
+    def close(self):
+        """ stop the threads of fetch_async """
+        self._workers.stop()
+
+
+class FakeUrlfetch(_FakeBoxcar):
+    """
+    Stand-in for the App Engine urlfetch api, see install()
+
+    Faults raise DeadlineExceededError or DownloadError, as urlfetch does.
+    """
+
+    Error = Error
+    DownloadError = DownloadError
+    DeadlineExceededError = DeadlineExceededError
+
+    def fetch(self, url, payload=None, method="GET", headers=None,
+              deadline=None, **kw):
+        """
+        Play a request, see urlfetch.fetch
+
+        @return: the response
+        """
+        try:
+            return _FakeResponse(self._serve(url, deadline))
+        except _Fault, e:
+            if (e.kind == "timeout"):
+                raise DeadlineExceededError("Deadline exceeded")
+            raise DownloadError("Connection reset")
+
+    def create_rpc(self, deadline=None, callback=None):
+        """
+        @return: an RPC for make_fetch_call, see urlfetch.create_rpc
+        """
+        return _FakeRpc(deadline)
+
+    def make_fetch_call(self, rpc, url, payload=None, method="GET",
+                        headers=None, **kw):
+        """ start playing a request on a thread, see urlfetch """
+        rpc._request = self._workers.submit(self.fetch, url, payload,
+                                            method, headers, rpc.deadline)
+
+    def install(self, module=boxcargae):
+        """
+        Replace the urlfetch api of module, boxcargae by default,
+        until uninstall()
+        """
+        self._module = module
+        self._saved = module.urlfetch
+        module.urlfetch = self
+
+    def uninstall(self):
+        """ put back the urlfetch api replaced by install() """
+        self._module.urlfetch = self._saved
+
+
+class _FakeRpc(object):
+    """ urlfetch RPC of FakeUrlfetch """
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self._request = None
+
+    def get_result(self):
+        """ wait for the request and return the response """
+        return self._request.get_result()
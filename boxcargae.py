@@ -6,16 +6,63 @@ Boxcar client api for providers.
 
 ## Import library functions
 import urllib
+import urlparse
+import random
+import time
+import httplib
+import socket
+import threading
 import logging
-from google.appengine.api import urlfetch
+import optparse
+import os
+import sys
+import csv
+import shutil
+import Queue
+from array import array
+from collections import OrderedDict, deque
+try:
+    from google.appengine.api import urlfetch
+except ImportError:
+    urlfetch = None
+try:
+    from google.appengine.api import taskqueue
+except ImportError:
+    taskqueue = None
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    memcache = None
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 try:
     from hashlib import md5
 except ImportError:
     from md5 import md5
 
 
-## Expose the ApiClient and error classes for importing
-__all__ = ["BoxcarApi", "BoxcarException"]
+## Expose the ApiClient, transport and error classes for importing
+__all__ = ["BoxcarApi", "BoxcarException", "BoxcarTransportError",
+           "BoxcarCircuitOpen", "BoxcarRateLimited", "CircuitBreaker",
+           "UrlfetchTransport", "HttpTransport",
+           "TaskQueue", "MemoryQueue", "DeliveryWorker", "is_retryable",
+           "TokenBucket", "AimdController",
+           "LocalStore", "MemcacheStore", "Deduplicator", "StatsCollector",
+           "NotificationCoalescer", "DeadlineScheduler",
+           "PriorityDispatcher", "digest_messages",
+           "AsyncBoxcarApi", "BoxcarFuture", "Outbox", "read_notifications",
+           "SubscriberCache", "SendResult", "ResultSet", "status_category",
+           "ClientRegistry", "default_registry"]
 
 
 class BoxcarApi(object):
@@ -41,7 +88,87 @@ class BoxcarApi(object):
     #     @var string
     _default_icon_url = ""
 
-    def __init__(self, api_key, secret, default_icon_url):
+    # The transport sending the requests
+    #     @var UrlfetchTransport or HttpTransport
+    _transport = None
+
+    # Number of requests notify_many keeps in flight by default
+    #     @var int
+    DEFAULT_WINDOW = 10
+
+    # The queue enqueue_notify / enqueue_broadcast write to
+    #     @var TaskQueue or MemoryQueue
+    _queue = None
+
+    # Limits the rate of requests, shared by clients if wanted
+    #     @var TokenBucket
+    _rate_limiter = None
+
+    # Adapts the number of requests in flight to the response codes
+    #     @var AimdController
+    _concurrency = None
+
+    # Skips notifications already sent with the same message_id
+    #     @var Deduplicator
+    _dedup = None
+
+    # Rejects requests while boxcar is failing
+    #     @var CircuitBreaker
+    _breaker = None
+
+    # Remembers the invite / notify outcomes per user
+    #     @var SubscriberCache
+    _subscribers = None
+
+    # The e-mail addresses of every subscriber, or a function returning them
+    #     @var collection or function
+    _audience = None
+
+    # Number of notify_many runs sent as a broadcast
+    #     @var int
+    promotions = 0
+
+    # Whether invite / notify / broadcast raise, or return a SendResult
+    #     @var bool
+    _raise_errors = True
+
+    # Share of the audience notify_many recipients must cover to be
+    # sent as one broadcast, see promote_fraction
+    #     @var float
+    _promote_fraction = 1.0
+
+    # Told about every request, see add_observer
+    #     @var list
+    _observers = ()
+
+    # Number of notifications written to the queue per task
+    #     @var int
+    BATCH_SIZE = 50
+
+    # Number of email -> MD5 digests remembered per client
+    #     @var int
+    MD5_CACHE_SIZE = 1024
+
+    # The tasks whose urls are built up front
+    #     @var tuple
+    TASKS = ("notifications", "notifications/broadcast",
+             "notifications/subscribe")
+
+    # The per message fields in the order they are encoded, url quoted
+    #     @var tuple
+    _MESSAGE_FIELDS = tuple(urllib.quote_plus(key) for key in (
+        "notification[from_screen_name]",
+        "notification[message]",
+        "notification[from_remote_service_id]",
+        "notification[redirect_payload]",
+        "notification[source_url]",
+        "notification[icon_url]"))
+
+    def __init__(self, api_key, secret, default_icon_url, transport=None,
+                 endpoint=None, queue=None, rate_limiter=None,
+                 concurrency=None, dedup=None, observers=None,
+                 breaker=None, subscribers=None, audience=None,
+                 promote_fraction=1.0, raise_errors=True):
         """
         Make a new instance of the API client
 
@@ -51,10 +178,102 @@ class BoxcarApi(object):
         @type secret: str
         @param default_icon_url: url to a 57x57 icon to use with a message
         @type default_icon_url: str
+        @param transport: Optional; the transport sending the requests,
+                          urlfetch on App Engine, a shared HttpTransport
+                          everywhere else
+        @type transport: UrlfetchTransport or HttpTransport
+        @param endpoint: Optional; the endpoint for service, if not ENDPOINT
+        @type endpoint: str
+        @param queue: Optional; the queue for enqueue_notify and
+                      enqueue_broadcast
+        @type queue: TaskQueue or MemoryQueue
+        @param rate_limiter: Optional; every request takes a token from it
+        @type rate_limiter: TokenBucket
+        @param concurrency: Optional; sizes the window of bulk sends
+                            when no window is given
+        @type concurrency: AimdController
+        @param dedup: Optional; remembers the message_ids sent to each user,
+                      so known duplicates fail without a request
+        @type dedup: Deduplicator
+        @param observers: Optional; observers of every request,
+                          see add_observer
+        @type observers: list
+        @param breaker: Optional; while it is open requests fail at once
+                        with BoxcarCircuitOpen, notify and broadcast are
+                        queued instead if there is a queue
+        @type breaker: CircuitBreaker
+        @param subscribers: Optional; invite skips users already invited
+                            or unknown, notify fails at once for users
+                            unknown or not subscribed
+        @type subscribers: SubscriberCache
+        @param audience: Optional; the e-mail addresses of every
+                         subscriber, or a function returning them;
+                         notify_many sends a single broadcast instead
+                         once the recipients cover promote_fraction of it
+        @type audience: collection or function
+        @param promote_fraction: Optional; the share of the audience the
+                                 recipients of notify_many must cover,
+                                 all of it by default. Below 1 the
+                                 broadcast also notifies the subscribers
+                                 who are not among the recipients
+        @type promote_fraction: float
+        @param raise_errors: Optional; if False invite, notify and
+                             broadcast return a SendResult rather than
+                             raising BoxcarException
+        @type raise_errors: bool
         """
         self._api_key = api_key
         self._secret = secret
         self._default_icon_url = default_icon_url
+        if (transport is None):
+            transport = default_transport()
+        self._transport = transport
+        if (endpoint is not None):
+            self.ENDPOINT = endpoint
+        # the constant part of every notification and the task urls
+        # are encoded once per client
+        self._prefix = urllib.urlencode([("token", _utf8(api_key)),
+                                         ("secret", _utf8(secret))])
+        self._urls = dict((task, self.ENDPOINT + api_key + "/" + task)
+                          for task in self.TASKS)
+        self._md5_cache = _LRUCache(self.MD5_CACHE_SIZE)
+        self._queue = queue
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._rate_limiter = rate_limiter
+        self._concurrency = concurrency
+        self._dedup = dedup
+        self._observers = list(observers or ())
+        self._breaker = breaker
+        self._subscribers = subscribers
+        self._audience = audience
+        self._promote_fraction = promote_fraction
+        self.promotions = 0
+        self._raise_errors = raise_errors
+
+    def add_observer(self, observer):
+        """
+        Tell an observer about every request of this client
+
+        The observer is called with
+            observer.before_request(task, size) before a request is sent
+            observer.after_request(task, size, latency, status_code)
+        once it is done, where size is the length of the POST body,
+        latency is in seconds and status_code is None if the transport
+        failed. StatsCollector is such an observer.
+
+        @param observer: the observer
+        @type observer: StatsCollector or alike
+        """
+        self._observers.append(observer)
+
+    def remove_observer(self, observer):
+        """
+        Stop telling an observer about the requests
+
+        @param observer: an observer given to add_observer
+        """
+        self._observers.remove(observer)
 
     def invite(self, email):
         """
@@ -62,14 +281,33 @@ class BoxcarApi(object):
 
         @param email: the email address to invite
         @type email: str
+        @return: bool, or SendResult if not raising errors
+        """
+        return self._outcome(email, self._invite, email)
+
+    def _invite(self, email):
+        """
+        Invite a user, see invite
+
         @return: bool
         """
+        if (self._subscribers is None):
+            _result = self._http_post("notifications/subscribe",
+                                      self._encode_fields({"email": email}))
+            return self._invite_response_handler(_result)
+        _email_hash = self._md5_email(email)
+        _state = self._subscribers.get(_email_hash)
+        if (_state == SubscriberCache.INVITED):
+            return True
+        if (_state == SubscriberCache.UNKNOWN):
+            raise BoxcarException("User not found (cached) %d" % 404, 404)
         _result = self._http_post("notifications/subscribe",
-                                {"email": email})
-        if (_result.status_code == 404):
-            raise BoxcarException("User not found %d" % _result.status_code)
-        else:
-            return self._default_response_handler(_result)
+                                  self._encode_fields({"email": email}))
+        if (_result.status_code == 200):
+            self._subscribers.set(_email_hash, SubscriberCache.INVITED)
+        elif (_result.status_code == 404):
+            self._subscribers.set(_email_hash, SubscriberCache.UNKNOWN)
+        return self._invite_response_handler(_result)
 
     def notify(self, email, name, message, message_id=None,
                payload=None, source_url=None, icon=None):
@@ -95,9 +333,11 @@ class BoxcarApi(object):
         @param icon: Optional; This is the URL of the icon that will be shown
                      to the user. Standard size is 57x57.
         @type icon: str
+        @return: True, or SendResult if not raising errors
         """
-        return self._do_notify("notifications", email, name, message,
-                               message_id, payload, source_url, icon)
+        return self._outcome(email, self._do_notify, "notifications", email,
+                             name, message, message_id, payload, source_url,
+                             icon)
 
     def broadcast(self, name, message, message_id=None, payload=None,
                   source_url=None, icon=None):
@@ -121,12 +361,396 @@ class BoxcarApi(object):
         @param icon: Optional; This is the URL of the icon that will be shown
                      to the user. Standard size is 57x57.
         @type icon: str
+        @return: True, or SendResult if not raising errors
+        """
+        return self._outcome(None, self._do_notify, "notifications/broadcast",
+                             None, name, message, message_id, payload,
+                             source_url, icon)
+
+    def _outcome(self, email, method, *args):
+        """
+        Call a send method, or unless raising errors return its SendResult
+
+        @param email: the users e-mail address, or None for a broadcast
+        @type email: str
+        @param method: the method sending, returning True once sent and
+                       False if queued
+        @return: the result of method, or SendResult
+        """
+        if (self._raise_errors):
+            return method(*args)
+        _start = time.time()
+        try:
+            if (method(*args)):
+                (_status_code, _category) = (200, "ok")
+            else:
+                (_status_code, _category) = (None, "queued")
+        except BoxcarException, e:
+            (_status_code, _category) = (e.status_code, e.category)
+        _email_hash = None
+        if (email is not None):
+            _email_hash = self._md5_email(email)
+        return SendResult(_status_code, _category, time.time() - _start,
+                          _email_hash)
+
+    def notify_many(self, recipients, name, message, message_id=None,
+                    payload=None, source_url=None, icon=None, window=None,
+                    compact=False):
+        """
+        Send the same notification to many users with concurrent requests
+
+        Failures do not stop the run, they are returned per recipient.
+        When the recipients cover promote_fraction of the audience, one
+        broadcast is sent instead of their notifications, and its result
+        is returned for each subscriber among them. A broadcast goes to
+        the whole audience: with promote_fraction below 1, subscribers
+        who are not among the recipients are notified as well.
+
+        @param recipients: the users e-mail addresses
+        @type recipients: list
+        @param name: the name of the sender
+        @type name: str
+        @param message: the message body
+        @type message: str
+        @param message_id: an optional unique id,
+                   will stop the same message getting sent twice
+        @type message_id: int
+        @param payload: Optional; The payload to be passed
+                        in as part of the redirection URL.
+        @type payload: str
+        @param source_url: Optional; This is a URL that may be used for
+                       future devices. It will replace the redirect payload.
+        @type source_url: str
+        @param icon: Optional; This is the URL of the icon that will be shown
+                     to the user. Standard size is 57x57.
+        @type icon: str
+        @param window: Optional; the maximum number of requests in flight
+        @type window: int
+        @param compact: Optional; return a ResultSet, no exception is
+                        raised for the failed sends
+        @type compact: bool
+        @return: list of (email, result) in the order of recipients,
+                 result is True or the BoxcarException raised for it,
+                 or a ResultSet in the order of recipients if compact
+        """
+        _recipients = list(recipients)
+        _promoted = self._promotion(_recipients)
+        _requests = []
+        if (_promoted):
+            _requests.append(("notifications/broadcast",
+                              self._encode_notification(None, name, message,
+                                                        message_id, payload,
+                                                        source_url, icon)))
+        # the request each recipient gets the result of
+        _positions = []
+        for _email in _recipients:
+            if (_email in _promoted):
+                _positions.append(0)
+                continue
+            _positions.append(len(_requests))
+            _requests.append(("notifications",
+                              self._encode_notification(_email, name, message,
+                                                        message_id, payload,
+                                                        source_url, icon)))
+        if (compact):
+            _sent = self._send_compact(_requests, window)
+            _result = ResultSet()
+            for (_email, _position) in zip(_recipients, _positions):
+                _result._copy(_sent, _position, self._md5_email(_email))
+            return _result
+        _results = self._send_batch(_requests, window)
+        return [(_email, _results[_position])
+                for (_email, _position) in zip(_recipients, _positions)]
+
+    def _promotion(self, recipients):
+        """
+        The recipients a broadcast is sent to instead, see notify_many
+
+        @param recipients: the users e-mail addresses
+        @type recipients: list
+        @return: the set of subscribers among recipients, empty unless
+                 they cover promote_fraction of the audience
+        """
+        if (self._audience is None):
+            return frozenset()
+        _audience = self._audience
+        if (callable(_audience)):
+            _audience = _audience()
+        _audience = set(_audience)
+        _covered = _audience.intersection(recipients)
+        # a broadcast saves nothing over a single notification
+        if ((len(_covered) < 2) or
+                (len(_covered) < self._promote_fraction * len(_audience))):
+            return frozenset()
+        self.promotions += 1
+        logging.info("notify_many to %d of %d subscribers sent as a broadcast",
+                     len(_covered), len(_audience))
+        return _covered
+
+    def notify_stream(self, notifications, window=None):
+        """
+        Send notifications pulled one by one from an iterable
+
+        Only the requests in flight are held in memory, so notifications
+        may come from a generator, a datastore cursor or a file reader.
+        Results are produced lazily, in the order of the notifications,
+        while the following ones are still being sent.
+
+        @param notifications: the notifications, each a dict of the
+                              arguments of notify or a tuple of them in
+                              the order of notify
+        @type notifications: iterable
+        @param window: Optional; the maximum number of requests in flight
+        @type window: int
+        @return: generator of (notification, result), result is True or
+                 the BoxcarException raised for it, a notification
+                 missing arguments gets one too without a request
+        """
+        return self._send_stream(self._encode_stream(notifications), window)
+
+    def _encode_stream(self, notifications):
+        """
+        The requests of notify_stream, see _send_stream
+
+        @return: generator of (notification, task, url encoded fields
+                 or the BoxcarException encoding them raised)
+        """
+        for _notification in notifications:
+            try:
+                _data = self._encode_item(_notification)
+            except BoxcarException, e:
+                _data = e
+            yield (_notification, "notifications", _data)
+
+    def _encode_item(self, notification):
+        """
+        Encode a notification given as a dict or tuple of notify arguments
+
+        @return str
+        @raise BoxcarException: if arguments are missing or unknown
+        """
+        try:
+            if (isinstance(notification, dict)):
+                return self._encode_notification(**notification)
+            return self._encode_notification(*notification)
+        except TypeError, e:
+            raise BoxcarException("Invalid notification: %s" % e, None,
+                                  "invalid")
+
+    def enqueue_notify(self, email, name, message, message_id=None,
+                       payload=None, source_url=None, icon=None):
+        """
+        Queue a notification for background delivery
+
+        Notifications are written to the queue BATCH_SIZE at a time,
+        call flush() to write the rest.
+
+        @param email: the users e-mail address
+        @type email: str
+        @param name: the name of the sender
+        @type name: str
+        @param message: the message body
+        @type message: str
+        @param message_id: an optional unique id,
+                   will stop the same message getting sent twice
+        @type message_id: int
+        @param payload: Optional; The redirect payload
+        @type payload: str
+        @param source_url: Optional; The source url
+        @type source_url: str
+        @param icon: Optional; The icon url
+        @type icon: str
+        """
+        self._enqueue("notifications", email, name, message, message_id,
+                      payload, source_url, icon)
+
+    def enqueue_broadcast(self, name, message, message_id=None, payload=None,
+                          source_url=None, icon=None):
+        """
+        Queue a notification to all users for background delivery
+
+        @param name: the name of the sender
+        @type name: str
+        @param message: the message body
+        @type message: str
+        @param message_id: an optional unique id,
+                   will stop the same message getting sent twice
+        @type message_id: int
+        @param payload: Optional; The redirect payload
+        @type payload: str
+        @param source_url: Optional; The source url
+        @type source_url: str
+        @param icon: Optional; The icon url
+        @type icon: str
+        """
+        self._enqueue("notifications/broadcast", None, name, message,
+                      message_id, payload, source_url, icon)
+
+    def flush(self):
+        """
+        Write the notifications still buffered by enqueue_* to the queue
+
+        @return: the number of notifications written
+        """
+        self._pending_lock.acquire()
+        try:
+            _pending = self._pending
+            self._pending = []
+        finally:
+            self._pending_lock.release()
+        if (_pending):
+            self._queue.add([json.dumps(_pending[i:i + self.BATCH_SIZE])
+                             for i in range(0, len(_pending),
+                                            self.BATCH_SIZE)])
+        return len(_pending)
+
+    def _enqueue(self, task, email, name, message, message_id=None,
+                 payload=None, source_url=None, icon=None):
+        """
+        Buffer a notification, writing a batch once BATCH_SIZE are waiting
+
+        @param task: path of task
+        @type task: str
+        """
+        if (self._queue is None):
+            raise BoxcarException("No queue configured")
+        _entry = {"task": task, "email": email, "name": name,
+                  "message": message, "message_id": message_id,
+                  "payload": payload, "source_url": source_url,
+                  "icon": icon, "attempt": 0}
+        self._pending_lock.acquire()
+        try:
+            self._pending.append(_entry)
+            _full = len(self._pending) >= self.BATCH_SIZE
+        finally:
+            self._pending_lock.release()
+        if (_full):
+            self.flush()
+
+    def _send_batch(self, requests, window=None):
+        """
+        Send encoded requests keeping up to window of them in flight
+
+        @param requests: (task, url encoded fields) of each request
+        @type requests: list
+        @param window: Optional; the maximum number of requests in flight,
+                       by default the concurrency controller decides
+        @type window: int
+        @return: list of results in the order of requests,
+                 True or the BoxcarException raised for it
+        """
+        return [_result for (_tag, _result) in self._send_stream(
+            ((None, _task, _data) for (_task, _data) in requests), window)]
+
+    def _send_stream(self, requests, window=None, collect=None):
+        """
+        Send encoded requests as they are pulled from an iterable,
+        keeping up to window of them in flight
+
+        A request failing to start does not stop the run, its error is
+        its result.
+
+        @param requests: (tag, task, url encoded fields) of each request,
+                         the tag is handed back with the result; fields
+                         given as a BoxcarException are its result
+        @type requests: iterable
+        @param window: Optional; the maximum number of requests in flight,
+                       by default the concurrency controller decides
+        @type window: int
+        @param collect: Optional; waits for an entry of (tag, pending
+                        request or the error starting it), _collect_rpc
+                        by default
+        @type collect: function
+        @return: generator of (tag, result) in the order of requests,
+                 result is True or the BoxcarException raised for it
+        """
+        if (collect is None):
+            collect = self._collect_rpc
+        _in_flight = deque()
+        for (_tag, _task, _data) in requests:
+            while (len(_in_flight) >= self._window(window)):
+                yield collect(_in_flight.popleft())
+            if (isinstance(_data, BoxcarException)):
+                _in_flight.append((_tag, _data))
+                continue
+            try:
+                _in_flight.append((_tag, self._http_post_async(_task, _data)))
+            except BoxcarException, e:
+                _in_flight.append((_tag, e))
+        while (_in_flight):
+            yield collect(_in_flight.popleft())
+
+    def _send_compact(self, requests, window=None):
+        """
+        Send encoded requests as _send_batch does, without raising for
+        the failed ones
+
+        @param requests: (task, url encoded fields) of each request
+        @type requests: list
+        @param window: Optional; the maximum number of requests in flight
+        @type window: int
+        @return: ResultSet in the order of requests, without e-mail MD5s
+        """
+        _results = ResultSet()
+        for (_tag, _outcome) in self._send_stream(
+                ((None, _task, _data) for (_task, _data) in requests),
+                window, self._collect_outcome):
+            (_status_code, _category, _latency) = _outcome
+            _results.append(_status_code, _category, _latency, None)
+        return _results
+
+    def _collect_outcome(self, entry):
         """
-        return self._do_notify("notifications/broadcast", None, name, message,
-                               message_id, payload, source_url, icon)
+        Wait for a request started by _send_stream, without raising
+
+        @param entry: (tag, pending request or the error starting it)
+        @type entry: tuple
+        @return: (tag, (status code, category, latency))
+        """
+        (_tag, _request) = entry
+        if (isinstance(_request, BoxcarException)):
+            return (_tag, (_request.status_code, _request.category, 0.0))
+        try:
+            _status_code = self._wait_result(_request).status_code
+            _category = status_category(_status_code)
+        except BoxcarTransportError, e:
+            (_status_code, _category) = (None, e.category)
+        # the request tuple holds its start time
+        return (_tag, (_status_code, _category, time.time() - _request[2]))
+
+    def _collect_rpc(self, entry):
+        """
+        Wait for a request started by _send_stream
+
+        @param entry: (tag, pending request or the error starting it)
+        @type entry: tuple
+        @return: (tag, result), result is True or the BoxcarException raised
+        """
+        (_tag, _rpc) = entry
+        if (isinstance(_rpc, BoxcarException)):
+            return (_tag, _rpc)
+        try:
+            return (_tag,
+                    self._default_response_handler(self._wait_result(_rpc)))
+        except BoxcarException, e:
+            return (_tag, e)
+
+    def _window(self, window=None):
+        """
+        The number of requests bulk sends may keep in flight
+
+        @param window: Optional; a fixed window
+        @type window: int
+        @return int
+        """
+        if (window is not None):
+            return window
+        if (self._concurrency is not None):
+            return self._concurrency.window
+        return self.DEFAULT_WINDOW
 
     def _do_notify(self, task, email, name, message, message_id=None,
-                   payload=None, source_url=None, icon=None):
+                   payload=None, source_url=None, icon=None, deadline=None):
         """
         Internal function for actually sending the notifications
 
@@ -149,35 +773,114 @@ class BoxcarApi(object):
         @param icon: Optional; This is the URL of the icon that will be shown
                      to the user. Standard size is 57x57.
         @type icon: str
+        @param deadline: Optional; seconds to wait for the response
+        @type deadline: float
+        @return: True once sent, False if queued because the circuit
+                 breaker is open
+        """
+        _email_hash = None
+        if ((self._subscribers is not None) and (email is not None)):
+            _email_hash = self._md5_email(email)
+            if (self._subscribers.get(_email_hash) in
+                    (SubscriberCache.UNKNOWN, SubscriberCache.UNSUBSCRIBED)):
+                raise BoxcarException("User not subscribed (cached) %d" %
+                                      401, 401, "unsubscribed")
+        _dedup_key = self._dedup_check(email, message_id)
+        _notification = self._encode_notification(email, name, message,
+                                                  message_id, payload,
+                                                  source_url, icon)
+        try:
+            _result = self._http_post(task, _notification, deadline)
+        except BoxcarCircuitOpen:
+            if (self._queue is None):
+                raise
+            self._enqueue(task, email, name, message, message_id,
+                          payload, source_url, icon)
+            # written at once, nothing else may flush the buffer
+            self.flush()
+            return False
+        # with a message_id, a 401 may only mean the id was sent before;
+        # a wrong secret answers 401 for every user too, so it is kept
+        # out of the tier other instances read
+        if ((_email_hash is not None) and (_result.status_code == 401) and
+                (message_id is None)):
+            self._subscribers.set(_email_hash, SubscriberCache.UNSUBSCRIBED,
+                                  shared=False)
+        _handled = self._default_response_handler(_result)
+        if (_dedup_key is not None):
+            self._dedup.mark(_dedup_key)
+        return _handled
+
+    def _dedup_check(self, email, message_id):
+        """
+        Fail a notification already sent, see Deduplicator
+
+        @param email: the users e-mail address, or None for a broadcast
+        @type email: str
+        @param message_id: the unique id of the notification
+        @type message_id: int
+        @return: the key to mark once sent, None if not deduplicated
+        """
+        if ((self._dedup is None) or (message_id is None)):
+            return None
+        _email_hash = None
+        if (email is not None):
+            _email_hash = self._md5_email(email)
+        _dedup_key = self._dedup.key(_email_hash, message_id)
+        if (self._dedup.seen(_dedup_key)):
+            # boxcar would answer 401 to the same id sent twice
+            raise BoxcarException("Duplicate notification (local) %d" %
+                                  401, 401, "duplicate")
+        return _dedup_key
+
+    def _encode_notification(self, email, name, message, message_id=None,
+                             payload=None, source_url=None, icon=None):
+        """
+        Encode the POST fields of a notification, leaving out unset values
+
+        @param email: the users e-mail address, or None for a broadcast
+        @type email: str
+        @param name: the name of the sender
+        @type name: str
+        @param message: the message body
+        @type message: str
+        @param message_id: an optional unique id
+        @type message_id: int
+        @param payload: Optional; The redirect payload
+        @type payload: str
+        @param source_url: Optional; The source url
+        @type source_url: str
+        @param icon: Optional; The icon url
+        @type icon: str
+        @return str
         """
         # if the icon was not set for this message,
         # check for the default icon and use that if set
         if ((icon is None) and (self._default_icon_url is not None)):
             icon = self._default_icon_url
-        # md5 email
+        _fields = [self._prefix]
         if (email is not None):
-            _dummy_md5 = md5()
-            _md5_email = md5(email).hexdigest()
-        else:
-            _md5_email = None
-        _notification = {
-            "token": self._api_key,
-            "secret": self._secret,
-            "email": _md5_email,
-            "notification[from_screen_name]": name,
-            "notification[message]": message,
-            "notification[from_remote_service_id]": message_id,
-            "notification[redirect_payload]": payload,
-            "notification[source_url]": source_url,
-            "notification[icon_url]": icon,
-        }
-        # unset the null ones...
-        _filtered_notification = dict()
-        for (key, val) in [(key, val) \
-            for (key, val) in _notification.iteritems() if val is not None]:
-            _filtered_notification[key] = val
-        _result = self._http_post(task, _filtered_notification)
-        return self._default_response_handler(_result)
+            _fields.append("email=" + self._md5_email(email))
+        for (key, val) in zip(self._MESSAGE_FIELDS,
+                              (name, message, message_id, payload,
+                               source_url, icon)):
+            if (val is not None):
+                _fields.append(key + "=" + urllib.quote_plus(_utf8(val)))
+        return "&".join(_fields)
+
+    def _md5_email(self, email):
+        """
+        MD5 hex digest of an e-mail address, cached
+
+        @param email: the users e-mail address
+        @type email: str
+        @return str
+        """
+        _digest = self._md5_cache.get(email)
+        if (_digest is None):
+            _digest = md5(_utf8(email)).hexdigest()
+            self._md5_cache.put(email, _digest)
+        return _digest
 
     def _default_response_handler(self, result):
         """
@@ -196,7 +899,7 @@ class BoxcarApi(object):
         elif (result.status_code == 400):
             # it is because you failed to send the proper parameters
             raise BoxcarException("Incorrect parameters passed %d" %
-                                  result.status_code)
+                                  result.status_code, result.status_code)
         elif (result.status_code == 401):
             # For request failures,
             # you will receive either HTTP status 403 or 401.
@@ -205,43 +908,2743 @@ class BoxcarApi(object):
             # or the user has not added your service.
             # Also, if you try and send the same notification id twice.
             raise BoxcarException("Request failed (Probably your fault) %d" %
-                                  result.status_code)
+                                  result.status_code, result.status_code)
         elif (result.status_code == 403):
             raise BoxcarException("Request failed (General) %d" %
-                                  result.status_code)
+                                  result.status_code, result.status_code)
         else:
             # Unkown code
-            raise BoxcarException("Unknown response: %d" % result.status_code)
+            raise BoxcarException("Unknown response: %d" % result.status_code,
+                                  result.status_code)
+
+    def _invite_response_handler(self, result):
+        """
+        Handle the response of an invite, where 404 is an unknown user
+
+        @param result: the response
+        @return: bool
+        """
+        if (result.status_code == 404):
+            raise BoxcarException("User not found %d" % result.status_code,
+                                  result.status_code)
+        else:
+            return self._default_response_handler(result)
 
-    def _http_post(self, task, data):
+    def _http_post(self, task, data, deadline=None):
         """
         HTTP POST a specific task with the supplied data
 
         @param task: path of task
         @type task: str
-        @param data: supplied data
-        @param date: dict
+        @param data: url encoded fields
+        @type data: str
+        @param deadline: Optional; seconds the call may take, waiting
+                         for the rate limiter included
+        @type deadline: float
         @return dict
         """
-        _url = self.ENDPOINT + self._api_key + "/" + task
-        _post_fields = urllib.urlencode(dict([key, val.encode("utf-8") \
-            if isinstance(val, unicode) else val] \
-            for (key, val) in data.iteritems()))
+        _called = time.time()
+        _start = self._before_request(task, data, deadline)
+        if ((deadline is not None) and (self._rate_limiter is not None)):
+            deadline = self._deadline_left(task, data, deadline, _called,
+                                           _start)
+        try:
+            _result = self._transport.fetch(self._task_url(task), data,
+                                            {"User-Agent": self.USERAGENT},
+                                            deadline)
+        except BoxcarTransportError:
+            self._after_request(task, data, _start, None)
+            raise
+        self._after_request(task, data, _start, _result.status_code)
+        return _result
+
+    def _http_post_async(self, task, data, deadline=None):
+        """
+        Start an asynchronous HTTP POST of a specific task
+
+        @param task: path of task
+        @type task: str
+        @param data: url encoded fields
+        @type data: str
+        @param deadline: Optional; seconds to wait for the response
+        @type deadline: float
+        @return: the pending request, pass it to _wait_result
+        """
+        _called = time.time()
+        _start = self._before_request(task, data, deadline)
+        if ((deadline is not None) and (self._rate_limiter is not None)):
+            deadline = self._deadline_left(task, data, deadline, _called,
+                                           _start)
+        try:
+            _rpc = self._transport.fetch_async(self._task_url(task), data,
+                                               {"User-Agent": self.USERAGENT},
+                                               deadline)
+        except BoxcarTransportError:
+            self._after_request(task, data, _start, None)
+            raise
+        return (task, data, _start, _rpc)
+
+    def _deadline_left(self, task, data, deadline, called, start):
+        """
+        What is left of a deadline after waiting for the rate limiter
+
+        @param called: the time the send was called
+        @type called: float
+        @param start: the time the request starts, see _before_request
+        @type start: float
+        @return: the seconds left
+        @raise BoxcarRateLimited: if none are left, the request is ended
+        """
+        # the limiter only sums its sleeps, the real wait can be longer
+        _left = deadline - (start - called)
+        if (_left <= 0):
+            self._after_request(task, data, start, None)
+            raise BoxcarRateLimited("No time left of %.3fs after the rate "
+                                    "limiter, not sending %s" %
+                                    (deadline, task))
+        return _left
+
+    def _wait_result(self, request):
+        """
+        Wait for a request started by _http_post_async
 
-        _result = urlfetch.fetch(_url,
-                                method="POST",
-                                headers={"User-Agent": self.USERAGENT},
-                                payload=_post_fields
-        )
+        @param request: the pending request
+        @return: the response
+        """
+        (_task, _data, _start, _rpc) = request
+        try:
+            _result = _rpc.get_result()
+        except BoxcarTransportError:
+            self._after_request(_task, _data, _start, None)
+            raise
+        self._after_request(_task, _data, _start, _result.status_code)
         return _result
 
+    def _before_request(self, task, data, deadline=None):
+        """
+        Wait for the rate limiter and tell the observers about a request
 
-class BoxcarException(Exception):
-    """ Boxcar exception """
+        @param task: path of task
+        @type task: str
+        @param data: url encoded fields
+        @type data: str
+        @param deadline: Optional; the most seconds to wait for the
+                         rate limiter
+        @type deadline: float
+        @return: the time the request starts
+        """
+        if ((self._breaker is not None) and (not self._breaker.allow())):
+            raise BoxcarCircuitOpen("Circuit open, not sending %s" % task)
+        if ((self._rate_limiter is not None) and
+                (self._rate_limiter.acquire(timeout=deadline) is None)):
+            raise BoxcarRateLimited("No rate limiter token within %.3fs, "
+                                    "not sending %s" % (deadline, task))
+        for _observer in self._observers:
+            _observer.before_request(task, len(data))
+        return time.time()
 
-    def __init__(self, error_msg):
-        self.msg = error_msg
+    def _after_request(self, task, data, start, status_code):
+        """
+        Account for the outcome of a request
 
-    def __str__(self):
-        return "Boxcar server returned error: %s" % self.msg
-#
+        @param task: path of task
+        @type task: str
+        @param data: url encoded fields
+        @type data: str
+        @param start: the time the request started
+        @type start: float
+        @param status_code: the HTTP status, None if the transport failed
+        @type status_code: int
+        """
+        if (self._concurrency is not None):
+            self._concurrency.on_status(status_code)
+        if (self._breaker is not None):
+            self._breaker.record(status_code)
+        if (self._observers):
+            _latency = time.time() - start
+            for _observer in self._observers:
+                _observer.after_request(task, len(data), _latency,
+                                        status_code)
+
+    def _task_url(self, task):
+        """
+        Build the url of a specific task
+
+        @param task: path of task
+        @type task: str
+        @return str
+        """
+        _url = self._urls.get(task)
+        if (_url is None):
+            _url = self.ENDPOINT + self._api_key + "/" + task
+        return _url
+
+    def _encode_fields(self, data):
+        """
+        UTF-8 and url encode the supplied data
+
+        @param data: supplied data
+        @type data: dict
+        @return str
+        """
+        return urllib.urlencode([(key, _utf8(val))
+                                 for (key, val) in data.iteritems()])
+
+
+class AsyncBoxcarApi(BoxcarApi):
+    """
+    Boxcar client whose calls return at once with a BoxcarFuture
+
+    Requests run as urlfetch RPCs on App Engine, or on the threads of
+    the HttpTransport pool elsewhere; up to max_in_flight of them are
+    outstanding, starting one more first waits for the oldest.
+    """
+
+    # Number of requests outstanding at once by default
+    #     @var int
+    MAX_IN_FLIGHT = 100
+
+    def __init__(self, api_key, secret, default_icon_url,
+                 max_in_flight=None, timeout=None, **kw):
+        """
+        Make a new instance of the API client
+
+        @param max_in_flight: Optional; overrides MAX_IN_FLIGHT
+        @type max_in_flight: int
+        @param timeout: Optional; default seconds each call may take
+        @type timeout: float
+
+        The other arguments are those of BoxcarApi.
+        """
+        BoxcarApi.__init__(self, api_key, secret, default_icon_url, **kw)
+        if (max_in_flight is not None):
+            self.MAX_IN_FLIGHT = max_in_flight
+        self._timeout = timeout
+        self._outstanding = deque()
+        self._outstanding_lock = threading.Lock()
+
+    def notify_async(self, email, name, message, message_id=None,
+                     payload=None, source_url=None, icon=None, timeout=None):
+        """
+        Start sending a notification, see BoxcarApi.notify
+
+        @param timeout: Optional; seconds the call may take
+        @type timeout: float
+        @return: BoxcarFuture, its get_result() returns True or raises
+                 BoxcarException
+        """
+        return self._start_notify("notifications", email, name, message,
+                                  message_id, payload, source_url, icon,
+                                  timeout)
+
+    def broadcast_async(self, name, message, message_id=None, payload=None,
+                        source_url=None, icon=None, timeout=None):
+        """
+        Start sending a notification to all users, see BoxcarApi.broadcast
+
+        @param timeout: Optional; seconds the call may take
+        @type timeout: float
+        @return: BoxcarFuture
+        """
+        return self._start_notify("notifications/broadcast", None, name,
+                                  message, message_id, payload, source_url,
+                                  icon, timeout)
+
+    def invite_async(self, email, timeout=None):
+        """
+        Start inviting a user, see BoxcarApi.invite
+
+        @param timeout: Optional; seconds the call may take
+        @type timeout: float
+        @return: BoxcarFuture
+        """
+        return self._start("notifications/subscribe",
+                           self._encode_fields({"email": email}),
+                           self._invite_response_handler, None, timeout)
+
+    def wait_all(self):
+        """
+        Wait for every outstanding call, their results stay in the futures
+        """
+        while (True):
+            _future = self._pop_outstanding()
+            if (_future is None):
+                return
+            _future.wait()
+
+    def _start_notify(self, task, email, name, message, message_id,
+                      payload, source_url, icon, timeout):
+        """ start a notification with deduplication """
+        try:
+            _dedup_key = self._dedup_check(email, message_id)
+        except BoxcarException, e:
+            return BoxcarFuture(self, None, None, None, e)
+        return self._start(task,
+                           self._encode_notification(email, name, message,
+                                                     message_id, payload,
+                                                     source_url, icon),
+                           self._default_response_handler, _dedup_key,
+                           timeout)
+
+    def _start(self, task, data, handler, dedup_key, timeout):
+        """
+        Start a request once there is room, return its BoxcarFuture
+        """
+        while (len(self._outstanding) >= self.MAX_IN_FLIGHT):
+            _oldest = self._pop_outstanding()
+            if (_oldest is not None):
+                _oldest.wait()
+        if (timeout is None):
+            timeout = self._timeout
+        try:
+            _request = self._http_post_async(task, data, timeout)
+        except BoxcarException, e:
+            return BoxcarFuture(self, None, None, None, e)
+        _future = BoxcarFuture(self, _request, handler, dedup_key)
+        self._outstanding_lock.acquire()
+        try:
+            self._outstanding.append(_future)
+        finally:
+            self._outstanding_lock.release()
+        return _future
+
+    def _pop_outstanding(self):
+        """ the oldest outstanding future, or None """
+        self._outstanding_lock.acquire()
+        try:
+            if (self._outstanding):
+                return self._outstanding.popleft()
+            return None
+        finally:
+            self._outstanding_lock.release()
+
+
+class BoxcarFuture(object):
+    """
+    Result of a call of AsyncBoxcarApi, shaped like a urlfetch RPC
+    """
+
+    def __init__(self, api, request, handler, dedup_key, error=None):
+        self._api = api
+        self._request = request
+        self._handler = handler
+        self._dedup_key = dedup_key
+        self._lock = threading.Lock()
+        self._done = error is not None
+        self._result = error
+
+    def wait(self):
+        """
+        Wait for the call to finish
+
+        @return: True or the BoxcarException raised
+        """
+        self._lock.acquire()
+        try:
+            if (not self._done):
+                try:
+                    self._result = self._handler(
+                        self._api._wait_result(self._request))
+                    if (self._dedup_key is not None):
+                        self._api._dedup.mark(self._dedup_key)
+                except BoxcarException, e:
+                    self._result = e
+                self._done = True
+                self._request = None
+            return self._result
+        finally:
+            self._lock.release()
+
+    def done(self):
+        """ whether the result is known """
+        return self._done
+
+    def get_result(self):
+        """
+        Wait for the call to finish
+
+        @return: True
+        @raise BoxcarException: if the call failed
+        """
+        _result = self.wait()
+        if (isinstance(_result, BoxcarException)):
+            raise _result
+        return _result
+
+
+class BoxcarException(Exception):
+    """ Boxcar exception """
+
+    # The category of errors of this class, None to use the status code
+    #     @var str
+    CATEGORY = None
+
+    def __init__(self, error_msg, status_code=None, category=None):
+        self.msg = error_msg
+        # the HTTP status of the response, None if there was none
+        self.status_code = status_code
+        # what went wrong, one of CATEGORIES
+        if (category is None):
+            category = self.CATEGORY or status_category(status_code)
+        self.category = category
+
+    def __str__(self):
+        return "Boxcar server returned error: %s" % self.msg
+#
+
+
+# The categories of send outcomes
+CATEGORIES = ("ok", "invalid", "unauthorized", "throttled", "not_found",
+              "server", "unknown", "transport", "circuit_open",
+              "duplicate", "unsubscribed", "queued", "rate_limited")
+
+
+def status_category(status_code):
+    """
+    The category of a response status
+
+    @param status_code: the HTTP status, None if there was no response
+    @type status_code: int
+    @return: one of CATEGORIES
+    """
+    if (status_code is None):
+        return "transport"
+    if (status_code >= 500):
+        return "server"
+    return {200: "ok", 400: "invalid", 401: "unauthorized",
+            403: "throttled", 404: "not_found"}.get(status_code, "unknown")
+
+
+class SendResult(object):
+    """
+    Outcome of a single send, returned instead of raising
+    """
+
+    __slots__ = ("status_code", "category", "latency", "email_hash")
+
+    def __init__(self, status_code, category, latency, email_hash):
+        """
+        @param status_code: the HTTP status, None if there was no response
+        @type status_code: int
+        @param category: one of CATEGORIES
+        @type category: str
+        @param latency: seconds the send took
+        @type latency: float
+        @param email_hash: the MD5 of the recipient, None for a broadcast
+        @type email_hash: str
+        """
+        self.status_code = status_code
+        self.category = category
+        self.latency = latency
+        self.email_hash = email_hash
+
+    def __nonzero__(self):
+        """ whether boxcar accepted the notification """
+        return self.category == "ok"
+
+    def __repr__(self):
+        return "<SendResult %s %s %s>" % (self.email_hash, self.status_code,
+                                          self.category)
+
+
+class ResultSet(object):
+    """
+    Outcomes of a bulk send, kept in arrays rather than one object each
+
+    Items are SendResult records built on access; the summaries work on
+    the arrays.
+    """
+
+    def __init__(self):
+        # status codes, 0 where there was no response
+        self._statuses = array("H")
+        # indexes in CATEGORIES
+        self._categories = array("B")
+        self._latencies = array("d")
+        self._hashes = []
+
+    def append(self, status_code, category, latency, email_hash):
+        """ add the outcome of a send, see SendResult """
+        self._statuses.append(status_code or 0)
+        self._categories.append(CATEGORIES.index(category))
+        self._latencies.append(latency)
+        self._hashes.append(email_hash)
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __getitem__(self, index):
+        return SendResult(self._statuses[index] or None,
+                          CATEGORIES[self._categories[index]],
+                          self._latencies[index], self._hashes[index])
+
+    def __iter__(self):
+        for _index in xrange(len(self._hashes)):
+            yield self[_index]
+
+    def counts(self):
+        """
+        @return: {status code: number of sends}, None for no response
+        """
+        _counts = {}
+        for _status in self._statuses:
+            _counts[_status] = _counts.get(_status, 0) + 1
+        if (0 in _counts):
+            _counts[None] = _counts.pop(0)
+        return _counts
+
+    def categories(self):
+        """
+        @return: {category: number of sends}
+        """
+        _counts = {}
+        for _category in self._categories:
+            _counts[_category] = _counts.get(_category, 0) + 1
+        return dict((CATEGORIES[_category], _count)
+                    for (_category, _count) in _counts.iteritems())
+
+    def failures(self):
+        """
+        @return: list of SendResult of the sends not accepted
+        """
+        _ok = CATEGORIES.index("ok")
+        return [self[_index] for (_index, _category)
+                in enumerate(self._categories) if _category != _ok]
+
+    def retryable(self):
+        """
+        @return: list of SendResult of the failures worth sending again,
+                 see is_retryable
+        """
+        return [_result for _result in self.failures()
+                if is_retryable(_result)]
+
+    def _copy(self, other, index, email_hash):
+        """ add an outcome of another ResultSet for another recipient """
+        self._statuses.append(other._statuses[index])
+        self._categories.append(other._categories[index])
+        self._latencies.append(other._latencies[index])
+        self._hashes.append(email_hash)
+
+    def latency_percentile(self, percent):
+        """
+        @return: the percent-th percentile of the latencies, None if empty
+        """
+        return _percentile(sorted(self._latencies), percent)
+
+
+def _utf8(val):
+    """ str of a value, UTF-8 encoding unicode """
+    if (isinstance(val, unicode)):
+        return val.encode("utf-8")
+    return str(val)
+
+
+class _LRUCache(object):
+    """ bounded thread-safe mapping dropping the least recently used keys """
+
+    def __init__(self, maxsize):
+        """
+        @param maxsize: the maximum number of keys kept
+        @type maxsize: int
+        """
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ value of key, marking it recently used, or default """
+        self._lock.acquire()
+        try:
+            try:
+                _val = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = _val
+            return _val
+        finally:
+            self._lock.release()
+
+    def put(self, key, val):
+        """ store val for key, dropping the oldest key when full """
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = val
+            if (len(self._data) > self._maxsize):
+                self._data.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class LocalStore(object):
+    """
+    In-process key/value store with a size bound and expiring entries
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        """
+        @param maxsize: the maximum number of keys kept
+        @type maxsize: int
+        @param ttl: Optional; default seconds an entry lives, None for ever
+        @type ttl: float
+        """
+        self._cache = _LRUCache(maxsize)
+        self._ttl = ttl
+
+    def get(self, key):
+        """ value of key, None if unknown or expired """
+        _entry = self._cache.get(key)
+        if (_entry is None):
+            return None
+        (_expires, _val) = _entry
+        if ((_expires is not None) and (_expires < time.time())):
+            return None
+        return _val
+
+    def set(self, key, val, ttl=None):
+        """
+        Store val for key
+
+        @param ttl: Optional; seconds the entry lives, if not the default
+        @type ttl: float
+        """
+        if (ttl is None):
+            ttl = self._ttl
+        _expires = None
+        if (ttl is not None):
+            _expires = time.time() + ttl
+        self._cache.put(key, (_expires, val))
+
+
+class MemcacheStore(object):
+    """
+    Key/value store on memcache, shared by all instances of the app
+    """
+
+    def __init__(self, client=None, prefix="boxcar:", ttl=None):
+        """
+        @param client: Optional; the memcache client, the App Engine
+                       memcache api by default
+        @type client: object with get(key) and set(key, val, time)
+        @param prefix: prefix of the keys
+        @type prefix: str
+        @param ttl: Optional; default seconds an entry lives, None for ever
+        @type ttl: float
+        """
+        if (client is None):
+            client = memcache
+        self._client = client
+        self._prefix = prefix
+        self._ttl = ttl
+
+    def get(self, key):
+        """ value of key, None if unknown or expired """
+        return self._client.get(self._prefix + key)
+
+    def set(self, key, val, ttl=None):
+        """
+        Store val for key
+
+        @param ttl: Optional; seconds the entry lives, if not the default
+        @type ttl: float
+        """
+        if (ttl is None):
+            ttl = self._ttl
+        self._client.set(self._prefix + key, val, time=ttl or 0)
+
+
+class Deduplicator(object):
+    """
+    Remembers the (user, message_id) pairs already sent
+    """
+
+    def __init__(self, store=None, ttl=86400):
+        """
+        @param store: Optional; where the sent pairs are kept,
+                      a LocalStore by default
+        @type store: LocalStore or MemcacheStore
+        @param ttl: seconds a sent pair is remembered
+        @type ttl: float
+        """
+        if (store is None):
+            store = LocalStore()
+        self._store = store
+        self._ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, email_hash, message_id):
+        """
+        The key of a notification
+
+        @param email_hash: the MD5 of the users e-mail, None for a broadcast
+        @type email_hash: str
+        @param message_id: the unique id of the notification
+        @type message_id: int
+        @return str
+        """
+        return "%s:%s" % (email_hash or "*", message_id)
+
+    def seen(self, key):
+        """
+        Whether the notification was already sent, counting hits and misses
+
+        @return bool
+        """
+        if (self._store.get(key) is not None):
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def mark(self, key):
+        """ remember the notification as sent """
+        self._store.set(key, 1, self._ttl)
+
+    def stats(self):
+        """
+        @return: dict with the hits and misses so far
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class SubscriberCache(object):
+    """
+    Remembers what boxcar answered about users, per e-mail MD5
+
+    Entries are looked up in an in-process tier first, then in an
+    optional shared tier, e.g. a MemcacheStore.
+    """
+
+    # Invited with a 200
+    INVITED = "invited"
+
+    # Unknown to boxcar, invite answered 404
+    UNKNOWN = "unknown"
+
+    # Has not added the provider, notify answered 401
+    UNSUBSCRIBED = "unsubscribed"
+
+    # Seconds each state is remembered by default
+    #     @var dict
+    TTLS = {INVITED: 7 * 86400, UNKNOWN: 86400, UNSUBSCRIBED: 3600}
+
+    def __init__(self, local=None, shared=None, ttls=None):
+        """
+        @param local: Optional; the in-process tier, a LocalStore by default
+        @type local: LocalStore
+        @param shared: Optional; the shared tier
+        @type shared: MemcacheStore
+        @param ttls: Optional; {state: seconds} overriding TTLS
+        @type ttls: dict
+        """
+        if (local is None):
+            local = LocalStore()
+        self._local = local
+        self._shared = shared
+        self.ttls = dict(self.TTLS)
+        self.ttls.update(ttls or {})
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, email_hash):
+        """
+        The state of a user
+
+        @param email_hash: the MD5 of the users e-mail address
+        @type email_hash: str
+        @return: INVITED, UNKNOWN, UNSUBSCRIBED or None if unknown
+        """
+        _state = self._local.get(email_hash)
+        if ((_state is None) and (self._shared is not None)):
+            _state = self._shared.get(email_hash)
+            if (_state is not None):
+                self._local.set(email_hash, _state, self.ttls[_state])
+        if (_state is None):
+            self.misses += 1
+        else:
+            self.hits += 1
+        return _state
+
+    def set(self, email_hash, state, shared=True):
+        """
+        Remember the state of a user for the TTL of the state
+
+        @param email_hash: the MD5 of the users e-mail address
+        @type email_hash: str
+        @param state: INVITED, UNKNOWN or UNSUBSCRIBED
+        @type state: str
+        @param shared: Optional; if False only the in-process tier
+                       remembers it
+        @type shared: bool
+        """
+        self._local.set(email_hash, state, self.ttls[state])
+        if (shared and (self._shared is not None)):
+            self._shared.set(email_hash, state, self.ttls[state])
+
+    def stats(self):
+        """
+        @return: dict with the hits and misses so far
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class BoxcarTransportError(BoxcarException):
+    """ the request could not be delivered to the boxcar servers """
+
+    CATEGORY = "transport"
+
+
+class BoxcarCircuitOpen(BoxcarException):
+    """ the request was not sent because the circuit breaker is open """
+
+    CATEGORY = "circuit_open"
+
+
+class BoxcarRateLimited(BoxcarException):
+    """ the request was not sent, no rate limiter token within its deadline """
+
+    CATEGORY = "rate_limited"
+
+
+class UrlfetchTransport(object):
+    """
+    Transport sending the requests with the App Engine urlfetch api
+    """
+
+    def fetch(self, url, payload, headers, deadline=None):
+        """
+        POST the payload and wait for the response
+
+        @param url: the url to post to
+        @type url: str
+        @param payload: the url encoded fields
+        @type payload: str
+        @param headers: the request headers
+        @type headers: dict
+        @param deadline: Optional; seconds to wait for the response,
+                         the urlfetch default if None
+        @type deadline: float
+        @return: the urlfetch response
+        """
+        _options = {}
+        if (deadline is not None):
+            _options["deadline"] = deadline
+        try:
+            return urlfetch.fetch(url,
+                                  method="POST",
+                                  headers=headers,
+                                  payload=payload,
+                                  **_options)
+        except urlfetch.Error, e:
+            raise BoxcarTransportError("Fetch failed: %s" % e)
+
+    def fetch_async(self, url, payload, headers, deadline=None):
+        """
+        Start a POST of the payload as an asynchronous urlfetch RPC
+
+        @param url: the url to post to
+        @type url: str
+        @param payload: the url encoded fields
+        @type payload: str
+        @param headers: the request headers
+        @type headers: dict
+        @param deadline: Optional; seconds to wait for the response
+        @type deadline: float
+        @return: the pending request, call get_result() on it for the response
+        """
+        try:
+            if (deadline is not None):
+                _rpc = urlfetch.create_rpc(deadline=deadline)
+            else:
+                _rpc = urlfetch.create_rpc()
+            urlfetch.make_fetch_call(_rpc, url,
+                                     method="POST",
+                                     headers=headers,
+                                     payload=payload)
+        except urlfetch.Error, e:
+            raise BoxcarTransportError("Fetch failed: %s" % e)
+        return _UrlfetchRequest(_rpc)
+
+
+class _UrlfetchRequest(object):
+    """ pending urlfetch RPC """
+
+    def __init__(self, rpc):
+        self._rpc = rpc
+
+    def get_result(self):
+        """ wait for the RPC and return the urlfetch response """
+        try:
+            return self._rpc.get_result()
+        except urlfetch.Error, e:
+            raise BoxcarTransportError("Fetch failed: %s" % e)
+
+
+class HttpTransport(object):
+    """
+    Transport sending the requests with httplib over persistent connections
+
+    Idle connections are kept in a pool per host, and the number of open
+    connections is bounded, so the transport can be shared by threads.
+
+    fetch_async queues the request for a pool of max_connections worker
+    threads, started on first use: any number of sends in flight cost a
+    queue entry each, not a thread, and requests past max_connections
+    wait in the queue for a connection rather than on a thread of their
+    own.
+    """
+
+    def __init__(self, max_connections=10, timeout=30):
+        """
+        Make a new connection pool
+
+        @param max_connections: the maximum number of open connections
+        @type max_connections: int
+        @param timeout: socket timeout in seconds
+        @type timeout: float
+        """
+        self._timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._workers = _WorkerPool(max_connections)
+
+    def fetch(self, url, payload, headers, deadline=None):
+        """
+        POST the payload and wait for the response
+
+        @param url: the url to post to
+        @type url: str
+        @param payload: the url encoded fields
+        @type payload: str
+        @param headers: the request headers
+        @type headers: dict
+        @param deadline: Optional; socket timeout for this request,
+                         the pool's timeout if None
+        @type deadline: float
+        @return: the response
+        """
+        (_scheme, _host, _path, _query, _fragment) = urlparse.urlsplit(url)
+        if (_query):
+            _path += "?" + _query
+        _key = (_scheme, _host)
+        _headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        _headers.update(headers)
+        self._slots.acquire()
+        try:
+            _conn = self._checkout(_key)
+            _reused = _conn is not None
+            if (not _reused):
+                _conn = self._connect(_key)
+            try:
+                _response = self._request(_conn, _path, payload, _headers,
+                                          deadline)
+            except (httplib.HTTPException, socket.error), e:
+                _conn.close()
+                if ((not _reused) or isinstance(e, socket.timeout)):
+                    raise BoxcarTransportError("Fetch failed: %s" % e)
+                # the server may have dropped the idle connection,
+                # try once more on a fresh one
+                _conn = self._connect(_key)
+                try:
+                    _response = self._request(_conn, _path, payload, _headers,
+                                              deadline)
+                except (httplib.HTTPException, socket.error), e:
+                    _conn.close()
+                    raise BoxcarTransportError("Fetch failed: %s" % e)
+            self._checkin(_key, _conn, _response)
+            return _response
+        finally:
+            self._slots.release()
+
+    def fetch_async(self, url, payload, headers, deadline=None):
+        """
+        Queue a POST of the payload for the worker threads
+
+        @param url: the url to post to
+        @type url: str
+        @param payload: the url encoded fields
+        @type payload: str
+        @param headers: the request headers
+        @type headers: dict
+        @param deadline: Optional; socket timeout for this request
+        @type deadline: float
+        @return: the pending request, call get_result() on it for the response
+        """
+        return self._workers.submit(self.fetch, url, payload, headers,
+                                    deadline)
+
+    def warm(self, url, connections=1):
+        """
+        Open connections to the host of url ahead of the first request
+
+        @param url: a url on the host
+        @type url: str
+        @param connections: the number of idle connections wanted
+        @type connections: int
+        @return: the number of connections opened
+        """
+        (_scheme, _host) = urlparse.urlsplit(url)[:2]
+        _key = (_scheme, _host)
+        self._lock.acquire()
+        try:
+            _wanted = connections - len(self._idle.get(_key, ()))
+        finally:
+            self._lock.release()
+        _opened = 0
+        for _i in range(_wanted):
+            _conn = self._connect(_key)
+            try:
+                _conn.connect()
+            except (httplib.HTTPException, socket.error), e:
+                logging.warning("Could not connect to %s: %s", _host, e)
+                break
+            self._lock.acquire()
+            try:
+                self._idle.setdefault(_key, []).append(_conn)
+            finally:
+                self._lock.release()
+            _opened += 1
+        return _opened
+
+    def close(self):
+        """ close all idle connections, and stop the worker threads """
+        self._workers.stop()
+        self._lock.acquire()
+        try:
+            _idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for _conns in _idle.itervalues():
+            for _conn in _conns:
+                _conn.close()
+
+    def _connect(self, key):
+        """ open a new connection to (scheme, host) """
+        (_scheme, _host) = key
+        if (_scheme == "https"):
+            return httplib.HTTPSConnection(_host, timeout=self._timeout)
+        return httplib.HTTPConnection(_host, timeout=self._timeout)
+
+    def _checkout(self, key):
+        """ take an idle connection from the pool, or None """
+        self._lock.acquire()
+        try:
+            _conns = self._idle.get(key)
+            if (_conns):
+                return _conns.pop()
+            return None
+        finally:
+            self._lock.release()
+
+    def _checkin(self, key, conn, response):
+        """ put a connection back in the pool if it can be reused """
+        if (response.will_close):
+            conn.close()
+            return
+        self._lock.acquire()
+        try:
+            self._idle.setdefault(key, []).append(conn)
+        finally:
+            self._lock.release()
+
+    def _request(self, conn, path, payload, headers, deadline=None):
+        """ send one request on conn and read the whole response """
+        _timeout = self._timeout
+        if (deadline is not None):
+            _timeout = deadline
+        if (conn.sock is None):
+            conn.timeout = _timeout
+        else:
+            conn.sock.settimeout(_timeout)
+        conn.request("POST", path, payload, headers)
+        _response = conn.getresponse()
+        return _HttpResponse(_response.status, _response.read(),
+                             dict(_response.getheaders()),
+                             _response.will_close)
+
+
+class _HttpResponse(object):
+    """ response of HttpTransport, shaped like the urlfetch one """
+
+    def __init__(self, status_code, content, headers, will_close):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.will_close = will_close
+
+
+class _WorkerPool(object):
+    """
+    Fixed number of threads running queued calls
+
+    The threads start with the first call, and again after stop().
+    """
+
+    def __init__(self, size):
+        """
+        @param size: the number of threads
+        @type size: int
+        """
+        self.size = size
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """
+        Queue a call
+
+        @return: _PoolRequest, call get_result() on it for the result
+        """
+        self._lock.acquire()
+        try:
+            if (not self._threads):
+                for _i in range(self.size):
+                    _thread = threading.Thread(target=self._run)
+                    _thread.setDaemon(True)
+                    _thread.start()
+                    self._threads.append(_thread)
+        finally:
+            self._lock.release()
+        _request = _PoolRequest()
+        self._queue.put((_request, func, args))
+        return _request
+
+    def stop(self):
+        """ let the threads finish the queued calls, then end """
+        self._lock.acquire()
+        try:
+            _threads = self._threads
+            self._threads = []
+        finally:
+            self._lock.release()
+        for _thread in _threads:
+            self._queue.put(None)
+
+    def _run(self):
+        """ the loop of a thread, until it takes None """
+        while (True):
+            _item = self._queue.get()
+            if (_item is None):
+                return
+            (_request, _func, _args) = _item
+            _request._run(_func, _args)
+
+
+class _PoolRequest(object):
+    """ call queued on a _WorkerPool, shaped like a urlfetch RPC """
+
+    def __init__(self):
+        self._result = None
+        self._error = None
+        self._done = threading.Event()
+
+    def _run(self, func, args):
+        try:
+            self._result = func(*args)
+        except Exception, e:
+            self._error = e
+        self._done.set()
+
+    def get_result(self):
+        """ wait for the call, return its result or raise its error """
+        self._done.wait()
+        if (self._error is not None):
+            raise self._error
+        return self._result
+
+
+class TaskQueue(object):
+    """
+    App Engine push queue the enqueued notification batches are written to
+    """
+
+    def __init__(self, url="/_boxcar/deliver", queue_name="default"):
+        """
+        @param url: the url of the handler running DeliveryWorker
+        @type url: str
+        @param queue_name: the name of the push queue
+        @type queue_name: str
+        """
+        self._url = url
+        self._queue_name = queue_name
+
+    def add(self, payloads, countdown=0):
+        """
+        Add one task per payload
+
+        @param payloads: the JSON encoded batches
+        @type payloads: list
+        @param countdown: seconds to wait before running the tasks
+        @type countdown: float
+        """
+        _queue = taskqueue.Queue(self._queue_name)
+        # the taskqueue api takes at most 100 tasks per call
+        for i in range(0, len(payloads), 100):
+            _queue.add([taskqueue.Task(url=self._url, payload=_payload,
+                                       countdown=countdown)
+                        for _payload in payloads[i:i + 100]])
+
+
+class MemoryQueue(object):
+    """
+    In-memory stand-in for TaskQueue, for tests and local runs
+    """
+
+    def __init__(self):
+        # (countdown, payload) of the tasks not run yet
+        self.tasks = []
+
+    def add(self, payloads, countdown=0):
+        """ see TaskQueue.add """
+        for _payload in payloads:
+            self.tasks.append((countdown, _payload))
+
+    def run(self, worker):
+        """
+        Hand every queued task to the worker once, ignoring countdowns
+
+        @param worker: the worker delivering the batches
+        @type worker: DeliveryWorker
+        @return: the number of tasks run
+        """
+        _tasks = self.tasks
+        self.tasks = []
+        for (_countdown, _payload) in _tasks:
+            worker.handle(_payload)
+        return len(_tasks)
+
+
+class DeliveryWorker(object):
+    """
+    Delivers the batches written by BoxcarApi.enqueue_notify and
+    enqueue_broadcast, retrying failed notifications with backoff
+
+    Only the notifications of a batch that failed with a retryable status
+    are queued again, so the task itself always succeeds.
+    Instances are WSGI applications for the queue's handler url.
+    """
+
+    # Number of sends before a notification is given up
+    #     @var int
+    MAX_ATTEMPTS = 5
+
+    # Backoff before the first retry, in seconds
+    #     @var float
+    BACKOFF_BASE = 10.0
+
+    # Longest backoff between retries, in seconds
+    #     @var float
+    BACKOFF_CAP = 3600.0
+
+    def __init__(self, api, max_attempts=None):
+        """
+        @param api: the client sending the notifications, its queue is
+                    used for the retries
+        @type api: BoxcarApi
+        @param max_attempts: Optional; overrides MAX_ATTEMPTS
+        @type max_attempts: int
+        """
+        self._api = api
+        if (max_attempts is not None):
+            self.MAX_ATTEMPTS = max_attempts
+
+    def handle(self, body):
+        """
+        Send a batch, queueing the retryable failures again
+
+        @param body: the JSON encoded batch
+        @type body: str
+        @return: dict with the number of notifications sent, retried
+                 and dropped
+        """
+        _batch = json.loads(body)
+        _requests = [(_entry["task"],
+                      self._api._encode_notification(_entry["email"],
+                                                     _entry["name"],
+                                                     _entry["message"],
+                                                     _entry["message_id"],
+                                                     _entry["payload"],
+                                                     _entry["source_url"],
+                                                     _entry["icon"]))
+                     for _entry in _batch]
+        _retries = {}
+        _stats = {"sent": 0, "retried": 0, "dropped": 0}
+        for (_entry, _result) in zip(_batch,
+                                     self._api._send_batch(_requests)):
+            if (_result is True):
+                _stats["sent"] += 1
+                continue
+            _entry["attempt"] += 1
+            if (is_retryable(_result) and
+                    _entry["attempt"] < self.MAX_ATTEMPTS):
+                _retries.setdefault(_entry["attempt"], []).append(_entry)
+                _stats["retried"] += 1
+            else:
+                logging.warning("Dropping boxcar notification after %d "
+                                "attempts: %s", _entry["attempt"], _result)
+                _stats["dropped"] += 1
+        for (_attempt, _entries) in _retries.iteritems():
+            self._api._queue.add([json.dumps(_entries)],
+                                 countdown=self.backoff(_attempt))
+        return _stats
+
+    def backoff(self, attempt):
+        """
+        Jittered exponential backoff before a retry
+
+        @param attempt: the number of sends so far
+        @type attempt: int
+        @return: seconds to wait
+        """
+        _delay = min(self.BACKOFF_CAP, self.BACKOFF_BASE * 2 ** (attempt - 1))
+        return _delay / 2 + random.uniform(0, _delay / 2)
+
+    def __call__(self, environ, start_response):
+        """ WSGI entry point, the request body is the batch """
+        _length = int(environ.get("CONTENT_LENGTH") or 0)
+        _stats = self.handle(environ["wsgi.input"].read(_length))
+        start_response("200 OK", [("Content-Type", "application/json")])
+        return [json.dumps(_stats)]
+
+
+def is_retryable(error):
+    """
+    Whether a failed send may succeed when tried again later
+
+    @param error: the error of the send
+    @type error: BoxcarException or SendResult
+    @return: True for transport errors, throttling (403) and server errors
+    """
+    return (error.status_code is None or error.status_code == 403 or
+            error.status_code >= 500)
+
+
+class TokenBucket(object):
+    """
+    Token bucket limiting the rate of requests
+
+    A bucket may be shared by clients and threads to give them one budget.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        @param rate: requests per second allowed in the long run
+        @type rate: float
+        @param burst: Optional; the most requests allowed at once,
+                      defaults to one second worth of rate
+        @type burst: float
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self._tokens = self.burst
+        self._stamp = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1, timeout=None):
+        """
+        Take tokens from the bucket, waiting until there are enough
+
+        @param tokens: the number of tokens to take
+        @type tokens: float
+        @param timeout: Optional; the most seconds to wait
+        @type timeout: float
+        @return: the seconds waited, None if the tokens would not come
+                 within timeout, then nothing is taken
+        """
+        _waited = 0.0
+        while (True):
+            _wait = self._take(tokens)
+            if (_wait <= 0):
+                return _waited
+            if ((timeout is not None) and (_waited + _wait > timeout)):
+                return None
+            time.sleep(_wait)
+            _waited += _wait
+
+    def try_acquire(self, tokens=1):
+        """
+        Take tokens from the bucket if there are enough, without waiting
+
+        @param tokens: the number of tokens to take
+        @type tokens: float
+        @return: bool
+        """
+        return self._take(tokens) <= 0
+
+    def _take(self, tokens):
+        """ take tokens, or return the seconds until there are enough """
+        self._lock.acquire()
+        try:
+            _now = time.time()
+            self._tokens = min(self.burst,
+                               self._tokens + (_now - self._stamp) * self.rate)
+            self._stamp = _now
+            if (self._tokens >= tokens):
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+        finally:
+            self._lock.release()
+
+
+class AimdController(object):
+    """
+    Additive increase / multiplicative decrease of the request window
+
+    The window shrinks when boxcar throttles (403), fails (5xx) or cannot
+    be reached, at most once per window of responses, and grows by
+    one request per window of successful responses.
+    """
+
+    def __init__(self, initial=10, minimum=1, maximum=100, decrease=0.5):
+        """
+        @param initial: the starting window
+        @type initial: int
+        @param minimum: the smallest window
+        @type minimum: int
+        @param maximum: the largest window
+        @type maximum: int
+        @param decrease: factor the window is multiplied by on congestion
+        @type decrease: float
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self._window = float(initial)
+        self._since_decrease = 0
+        self._lock = threading.Lock()
+
+    def _get_window(self):
+        return int(self._window)
+    window = property(_get_window, doc="the current window")
+
+    def on_status(self, status_code):
+        """
+        Adjust the window to the outcome of a request
+
+        @param status_code: the HTTP status, None if the transport failed
+        @type status_code: int
+        """
+        self._lock.acquire()
+        try:
+            self._since_decrease += 1
+            if (status_code is None or status_code == 403 or
+                    status_code >= 500):
+                if (self._since_decrease >= self._window):
+                    self._window = max(self.minimum,
+                                       self._window * self.decrease)
+                    self._since_decrease = 0
+            elif (status_code == 200):
+                self._window = min(self.maximum,
+                                   self._window + 1.0 / self._window)
+        finally:
+            self._lock.release()
+
+
+class StatsCollector(object):
+    """
+    Observer keeping per task request counts, status histograms and
+    latency percentiles
+
+    Instances are WSGI applications serving the stats as JSON.
+    """
+
+    # Number of latencies kept per task for the percentiles
+    #     @var int
+    SAMPLES = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ forget everything collected so far """
+        self._lock.acquire()
+        try:
+            self._tasks = {}
+        finally:
+            self._lock.release()
+
+    def before_request(self, task, size):
+        """ see BoxcarApi.add_observer """
+        self._lock.acquire()
+        try:
+            self._task(task)["in_flight"] += 1
+        finally:
+            self._lock.release()
+
+    def after_request(self, task, size, latency, status_code):
+        """ see BoxcarApi.add_observer """
+        self._lock.acquire()
+        try:
+            _stats = self._task(task)
+            _stats["in_flight"] -= 1
+            _stats["requests"] += 1
+            _stats["bytes"] += size
+            _stats["latency_total"] += latency
+            _key = status_code is None and "error" or str(status_code)
+            _stats["statuses"][_key] = _stats["statuses"].get(_key, 0) + 1
+            # the samples are a ring of the latest latencies
+            _samples = _stats["samples"]
+            if (len(_samples) < self.SAMPLES):
+                _samples.append(latency)
+            else:
+                _samples[_stats["requests"] % self.SAMPLES] = latency
+        finally:
+            self._lock.release()
+
+    def as_dict(self):
+        """
+        The stats of every task
+
+        @return: {task: {"requests", "in_flight", "bytes", "statuses",
+                         "latency_mean", "latency_p50", "latency_p90",
+                         "latency_p99"}}, latencies in seconds
+        """
+        self._lock.acquire()
+        try:
+            _result = {}
+            for (_task, _stats) in self._tasks.iteritems():
+                _samples = sorted(_stats["samples"])
+                _entry = {"requests": _stats["requests"],
+                          "in_flight": _stats["in_flight"],
+                          "bytes": _stats["bytes"],
+                          "statuses": dict(_stats["statuses"]),
+                          "latency_mean": None}
+                if (_stats["requests"]):
+                    _entry["latency_mean"] = (_stats["latency_total"] /
+                                              _stats["requests"])
+                for _percent in (50, 90, 99):
+                    _entry["latency_p%d" % _percent] = _percentile(_samples,
+                                                                   _percent)
+                _result[_task] = _entry
+            return _result
+        finally:
+            self._lock.release()
+
+    def __call__(self, environ, start_response):
+        """ WSGI entry point serving as_dict() as JSON """
+        start_response("200 OK", [("Content-Type", "application/json")])
+        return [json.dumps(self.as_dict(), sort_keys=True)]
+
+    def _task(self, task):
+        """ the stats of a task, created if needed """
+        _stats = self._tasks.get(task)
+        if (_stats is None):
+            _stats = {"requests": 0, "in_flight": 0, "bytes": 0,
+                      "latency_total": 0.0, "statuses": {}, "samples": []}
+            self._tasks[task] = _stats
+        return _stats
+
+
+def _percentile(values, percent):
+    """ the percent-th percentile of sorted values, None if empty """
+    if (not values):
+        return None
+    return values[int(round(percent / 100.0 * (len(values) - 1)))]
+
+
+class CircuitBreaker(object):
+    """
+    Stops requests to boxcar while it keeps failing
+
+    The circuit opens after failure_threshold consecutive failures, or
+    when error_rate of the last window requests failed. Once open, it
+    lets a single trial request through after reset_timeout seconds:
+    the circuit closes if it succeeds and opens again if it fails. A
+    trial whose outcome is not recorded within reset_timeout, e.g. a
+    future nobody waits on, is replaced by a new one. Failures are
+    transport errors and 5xx responses.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, error_rate=None, window=20,
+                 reset_timeout=30.0):
+        """
+        @param failure_threshold: consecutive failures opening the circuit
+        @type failure_threshold: int
+        @param error_rate: Optional; failed fraction of the last window
+                           requests opening the circuit
+        @type error_rate: float
+        @param window: the number of requests error_rate looks at
+        @type window: int
+        @param reset_timeout: seconds before a trial request is let through
+        @type reset_timeout: float
+        """
+        self.failure_threshold = failure_threshold
+        self.error_rate = error_rate
+        self.reset_timeout = reset_timeout
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened = None
+        # when the trial request was let through, None if not yet
+        self._trial = None
+
+    def _get_state(self):
+        return self._state
+    state = property(_get_state, doc="CLOSED, OPEN or HALF_OPEN")
+
+    def allow(self):
+        """
+        Whether a request may be sent now
+
+        @return bool
+        """
+        self._lock.acquire()
+        try:
+            if (self._state == self.CLOSED):
+                return True
+            if ((self._state == self.OPEN) and
+                    (time.time() - self._opened >= self.reset_timeout)):
+                self._state = self.HALF_OPEN
+                self._trial = None
+            if ((self._state == self.HALF_OPEN) and
+                    ((self._trial is None) or
+                     (time.time() - self._trial >= self.reset_timeout))):
+                self._trial = time.time()
+                return True
+            return False
+        finally:
+            self._lock.release()
+
+    def record(self, status_code):
+        """
+        Account for the outcome of a request let through
+
+        @param status_code: the HTTP status, None if the transport failed
+        @type status_code: int
+        """
+        _failed = (status_code is None) or (status_code >= 500)
+        self._lock.acquire()
+        try:
+            if (self._state == self.HALF_OPEN):
+                if (_failed):
+                    self._open()
+                else:
+                    self._state = self.CLOSED
+                    self._failures = 0
+                    self._recent.clear()
+                return
+            if (self._state == self.OPEN):
+                return
+            self._recent.append(_failed)
+            if (not _failed):
+                self._failures = 0
+                return
+            self._failures += 1
+            if (self._failures >= self.failure_threshold):
+                self._open()
+            elif ((self.error_rate is not None) and
+                    (len(self._recent) == self._recent.maxlen) and
+                    (float(sum(self._recent)) / len(self._recent) >=
+                     self.error_rate)):
+                self._open()
+        finally:
+            self._lock.release()
+
+    def _open(self):
+        """ open the circuit, the lock is held """
+        logging.warning("Boxcar circuit breaker opened")
+        self._state = self.OPEN
+        self._opened = time.time()
+        self._failures = 0
+        self._recent.clear()
+
+
+def digest_messages(messages):
+    """
+    Default merge of NotificationCoalescer, one line per message
+
+    @param messages: the buffered message bodies, oldest first
+    @type messages: list
+    @return: the message of the combined notification
+    """
+    if (len(messages) == 1):
+        return messages[0]
+    return u"%d messages:\n%s" % (len(messages),
+                                   u"\n".join(_unicode(_message)
+                                               for _message in messages))
+
+
+def _unicode(val):
+    """ unicode of a value, decoding str as UTF-8 """
+    if (isinstance(val, str)):
+        return val.decode("utf-8")
+    return unicode(val)
+
+
+class NotificationCoalescer(object):
+    """
+    Buffers notifications per (email, sender name) and sends each burst
+    as one combined notification
+
+    A buffer is sent once it holds max_count messages, or on the first
+    call after its window elapsed; call flush() to send everything,
+    e.g. at the end of a request.
+    """
+
+    def __init__(self, api, window=10.0, max_count=20,
+                 formatter=digest_messages):
+        """
+        @param api: the client sending the combined notifications
+        @type api: BoxcarApi
+        @param window: seconds a buffer collects messages
+        @type window: float
+        @param max_count: messages sending a buffer at once
+        @type max_count: int
+        @param formatter: merges the buffered messages into one
+        @type formatter: function(list of messages) -> message
+        """
+        self._api = api
+        self.window = window
+        self.max_count = max_count
+        self._formatter = formatter
+        self._buffers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def notify(self, email, name, message, message_id=None, payload=None,
+               source_url=None, icon=None):
+        """
+        Buffer a notification, see BoxcarApi.notify
+
+        The payload, source url and icon of the latest message are used
+        for the combined one; message_id is kept for a single message.
+
+        @return: list of ((email, name), result) of the buffers sent by
+                 this call, result is True or the BoxcarException raised
+        """
+        _now = time.time()
+        _key = (email, name)
+        self._lock.acquire()
+        try:
+            _buffer = self._buffers.get(_key)
+            if (_buffer is None):
+                _buffer = {"start": _now, "messages": []}
+                self._buffers[_key] = _buffer
+            _buffer["messages"].append(message)
+            _buffer["last"] = (message_id, payload, source_url, icon)
+            _ready = self._take(_now, _key)
+        finally:
+            self._lock.release()
+        return self._send(_ready)
+
+    def flush(self):
+        """
+        Send every buffer now
+
+        @return: list of ((email, name), result)
+        """
+        self._lock.acquire()
+        try:
+            _ready = self._buffers.items()
+            self._buffers = OrderedDict()
+        finally:
+            self._lock.release()
+        return self._send(_ready)
+
+    def flush_expired(self):
+        """
+        Send the buffers whose window elapsed
+
+        @return: list of ((email, name), result)
+        """
+        self._lock.acquire()
+        try:
+            _ready = self._take(time.time())
+        finally:
+            self._lock.release()
+        return self._send(_ready)
+
+    def __len__(self):
+        """ the number of buffered messages """
+        return sum(len(_buffer["messages"])
+                   for _buffer in self._buffers.itervalues())
+
+    def _take(self, now, full=None):
+        """
+        Remove the expired buffers, and the full one, the lock is held
+
+        @return: list of (key, buffer)
+        """
+        _ready = []
+        # buffers are kept oldest first
+        for (_key, _buffer) in self._buffers.items():
+            if (now - _buffer["start"] < self.window):
+                break
+            _ready.append((_key, self._buffers.pop(_key)))
+        if ((full in self._buffers) and
+                (len(self._buffers[full]["messages"]) >= self.max_count)):
+            _ready.append((full, self._buffers.pop(full)))
+        return _ready
+
+    def _send(self, ready):
+        """ send the combined notification of each buffer """
+        _results = []
+        for ((_email, _name), _buffer) in ready:
+            _messages = _buffer["messages"]
+            (_message_id, _payload, _source_url, _icon) = _buffer["last"]
+            if (len(_messages) > 1):
+                _message_id = None
+            try:
+                _result = self._api._do_notify("notifications", _email,
+                                               _name,
+                                               self._formatter(_messages),
+                                               _message_id, _payload,
+                                               _source_url, _icon)
+            except BoxcarException, e:
+                _result = e
+            _results.append(((_email, _name), _result))
+        return _results
+
+
+class DeadlineScheduler(object):
+    """
+    Sends notifications inline while a request's time budget lasts and
+    queues the rest for background delivery
+
+    Each inline send gets a deadline of the time left, less the reserve
+    kept for the rest of the request, covering both the wait for the
+    api's rate limiter and the fetch, so a slow call cannot overrun the
+    budget. Once less than min_deadline is left, or a send times out or
+    gets no rate limiter token in time, the remaining notifications go
+    to the api's queue.
+    """
+
+    def __init__(self, api, budget, reserve=0.5, min_deadline=1.0,
+                 max_deadline=10.0):
+        """
+        @param api: the client sending and queueing, it needs a queue
+        @type api: BoxcarApi
+        @param budget: seconds the sends may take, from now
+        @type budget: float
+        @param reserve: seconds of the budget kept for the caller
+        @type reserve: float
+        @param min_deadline: the shortest deadline a send is tried with
+        @type min_deadline: float
+        @param max_deadline: the longest deadline of a single send
+        @type max_deadline: float
+        """
+        if (api._queue is None):
+            raise BoxcarException("No queue configured")
+        self._api = api
+        self.budget = budget
+        self.reserve = reserve
+        self.min_deadline = min_deadline
+        self.max_deadline = max_deadline
+        self._start = time.time()
+
+    def remaining(self):
+        """
+        @return: seconds left for inline sends, may be negative
+        """
+        return self.budget - self.reserve - (time.time() - self._start)
+
+    def send(self, notifications):
+        """
+        Send or queue notifications, given as for BoxcarApi.notify_stream
+
+        @param notifications: dicts or tuples of notify arguments
+        @type notifications: iterable
+        @return: list of (notification, path, result), path is "inline"
+                 with True or the BoxcarException raised, or "queued"
+                 with None
+        """
+        _results = []
+        _expired = False
+        for _notification in notifications:
+            _args = self._arguments(_notification)
+            _remaining = self.remaining()
+            if ((not _expired) and (_remaining >= self.min_deadline)):
+                try:
+                    _result = self._api._do_notify(
+                        "notifications", *_args,
+                        deadline=min(_remaining, self.max_deadline))
+                    if (_result):
+                        _results.append((_notification, "inline", True))
+                    else:
+                        # queued by _do_notify, the circuit is open
+                        _results.append((_notification, "queued", None))
+                    continue
+                except (BoxcarTransportError, BoxcarRateLimited):
+                    # a timeout, or waiting for the rate limiter, leaves
+                    # too little time for the rest
+                    _expired = True
+                except BoxcarException, e:
+                    _results.append((_notification, "inline", e))
+                    continue
+            self._api._enqueue("notifications", *_args)
+            _results.append((_notification, "queued", None))
+        self._api.flush()
+        return _results
+
+    def _arguments(self, notification):
+        """
+        @return: the notify arguments of a dict or tuple, as a tuple
+        """
+        if (isinstance(notification, dict)):
+            return (notification["email"], notification["name"],
+                    notification["message"],
+                    notification.get("message_id"),
+                    notification.get("payload"),
+                    notification.get("source_url"),
+                    notification.get("icon"))
+        return (tuple(notification) + (None,) * 7)[:7]
+
+
+class PriorityDispatcher(object):
+    """
+    Sends notifications from a pool of threads through lanes of priority
+
+    Each lane has its own queue, concurrency and optional rate limiter.
+    A free thread always takes from the highest priority lane that has
+    work and room, so interactive sends start ahead of any queued bulk
+    work; with the default pool size every lane can run at its full
+    concurrency, so a lane never waits for threads held by another.
+    """
+
+    # The default lanes, highest priority first:
+    # (name, concurrency, rate limiter or None)
+    #     @var tuple
+    LANES = (("interactive", 4, None), ("bulk", 2, None))
+    # Seconds between checks of a lane held back by its rate limiter
+    #     @var float
+    POLL = 0.05
+    # Number of queue waits kept per lane for the percentiles
+    #     @var int
+    SAMPLES = 1000
+
+    def __init__(self, api, lanes=None, workers=None):
+        """
+        @param api: the client sending the notifications
+        @type api: BoxcarApi
+        @param lanes: Optional; overrides LANES
+        @type lanes: list of (str, int, TokenBucket)
+        @param workers: Optional; the number of threads, defaults to
+                        the sum of the lane concurrencies
+        @type workers: int
+        """
+        self._api = api
+        self._lanes = OrderedDict()
+        for (_name, _concurrency, _rate_limiter) in (lanes or self.LANES):
+            self._lanes[_name] = {"concurrency": _concurrency,
+                                  "rate_limiter": _rate_limiter,
+                                  "queue": deque(), "active": 0, "sent": 0,
+                                  "waits": deque(maxlen=self.SAMPLES)}
+        self._cond = threading.Condition()
+        self._closed = False
+        if (workers is None):
+            workers = sum(_lane["concurrency"]
+                          for _lane in self._lanes.itervalues())
+        self._threads = []
+        for _i in range(workers):
+            _thread = threading.Thread(target=self._run)
+            _thread.setDaemon(True)
+            _thread.start()
+            self._threads.append(_thread)
+
+    def notify(self, email, name, message, message_id=None, payload=None,
+               source_url=None, icon=None, lane="interactive"):
+        """
+        Queue a notification on a lane, see BoxcarApi.notify
+
+        @param lane: the name of the lane
+        @type lane: str
+        @return: _LaneRequest, its get_result() returns True or raises
+                 BoxcarException
+        """
+        return self._submit(lane, "notifications", email, name, message,
+                            message_id, payload, source_url, icon)
+
+    def broadcast(self, name, message, message_id=None, payload=None,
+                  source_url=None, icon=None, lane="bulk"):
+        """
+        Queue a notification to all users on a lane, see BoxcarApi.broadcast
+
+        @param lane: the name of the lane
+        @type lane: str
+        @return: _LaneRequest
+        """
+        return self._submit(lane, "notifications/broadcast", None, name,
+                            message, message_id, payload, source_url, icon)
+
+    def stats(self):
+        """
+        The state and queue wait times of every lane
+
+        @return: {lane: {"queued", "active", "sent", "wait_p50",
+                         "wait_p90", "wait_p99", "wait_max"}},
+                 waits in seconds
+        """
+        self._cond.acquire()
+        try:
+            _result = {}
+            for (_name, _lane) in self._lanes.iteritems():
+                _waits = sorted(_lane["waits"])
+                _entry = {"queued": len(_lane["queue"]),
+                          "active": _lane["active"], "sent": _lane["sent"],
+                          "wait_max": None}
+                if (_waits):
+                    _entry["wait_max"] = _waits[-1]
+                for _percent in (50, 90, 99):
+                    _entry["wait_p%d" % _percent] = _percentile(_waits,
+                                                                _percent)
+                _result[_name] = _entry
+            return _result
+        finally:
+            self._cond.release()
+
+    def close(self):
+        """
+        Send what is queued, then stop the threads
+        """
+        self._cond.acquire()
+        try:
+            self._closed = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        for _thread in self._threads:
+            _thread.join()
+
+    def _submit(self, lane, task, *args):
+        """ queue a call of _do_notify on a lane """
+        if (lane not in self._lanes):
+            raise BoxcarException("Unknown lane %s" % lane)
+        _request = _LaneRequest()
+        self._cond.acquire()
+        try:
+            if (self._closed):
+                raise BoxcarException("Dispatcher closed")
+            self._lanes[lane]["queue"].append((time.time(), task, args,
+                                               _request))
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        return _request
+
+    def _next(self):
+        """
+        Take the next call from the highest priority lane able to send,
+        the lock is held
+
+        @return: (lane, entry), or (None, None) with whether a lane is
+                 held back by its rate limiter
+        """
+        _limited = False
+        for _lane in self._lanes.itervalues():
+            if ((not _lane["queue"]) or
+                    (_lane["active"] >= _lane["concurrency"])):
+                continue
+            if ((_lane["rate_limiter"] is not None) and
+                    (not _lane["rate_limiter"].try_acquire())):
+                _limited = True
+                continue
+            _entry = _lane["queue"].popleft()
+            _lane["active"] += 1
+            _lane["waits"].append(time.time() - _entry[0])
+            return (_lane, _entry)
+        return (None, _limited)
+
+    def _run(self):
+        """ the loop of a thread """
+        while (True):
+            self._cond.acquire()
+            try:
+                while (True):
+                    (_lane, _entry) = self._next()
+                    if (_lane is not None):
+                        break
+                    if (self._closed and
+                            not any(_queued["queue"] for _queued
+                                    in self._lanes.itervalues())):
+                        return
+                    # _entry tells whether a lane waits for its limiter
+                    self._cond.wait(_entry and self.POLL or None)
+            finally:
+                self._cond.release()
+            (_queued, _task, _args, _request) = _entry
+            try:
+                try:
+                    _request._set(self._api._do_notify(_task, *_args))
+                except Exception, e:
+                    # any error is the caller's, the thread carries on
+                    _request._set(e)
+            finally:
+                self._cond.acquire()
+                try:
+                    _lane["active"] -= 1
+                    _lane["sent"] += 1
+                    self._cond.notifyAll()
+                finally:
+                    self._cond.release()
+
+
+class _LaneRequest(object):
+    """ Result of a call queued on a PriorityDispatcher """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+
+    def _set(self, result):
+        self._result = result
+        self._event.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the call to finish
+
+        @return: True, False if queued by the api, or the exception
+                 raised, usually a BoxcarException
+        """
+        self._event.wait(timeout)
+        return self._result
+
+    def done(self):
+        """ whether the result is known """
+        return self._event.isSet()
+
+    def get_result(self):
+        """
+        Wait for the call to finish
+
+        @return: True
+        @raise BoxcarException: if the call failed, or the other
+                                exception it raised
+        """
+        _result = self.wait()
+        if (isinstance(_result, Exception)):
+            raise _result
+        return _result
+
+
+class Outbox(object):
+    """
+    Crash-safe log of notifications in a SQLite database
+
+    Every notification is written to the log before it is sent and
+    acknowledged once boxcar accepted it, so replay() can resume where a
+    dead process stopped. Records and acknowledgements are committed
+    COMMIT_SIZE at a time, with the database in WAL mode, so the log
+    syncs to disk once per group rather than once per notification.
+    """
+
+    # Record states
+    PENDING = 0
+    SENT = 1
+    FAILED = 2
+
+    # Number of notifications written or acknowledged per commit
+    #     @var int
+    COMMIT_SIZE = 500
+
+    # The columns of a notification, in the order of _do_notify
+    _COLUMNS = ("task", "email", "name", "message", "message_id", "payload",
+                "source_url", "icon")
+
+    def __init__(self, path, commit_size=None):
+        """
+        Open or create an outbox
+
+        @param path: the file of the SQLite database
+        @type path: str
+        @param commit_size: Optional; overrides COMMIT_SIZE
+        @type commit_size: int
+        """
+        if (commit_size is not None):
+            self.COMMIT_SIZE = commit_size
+        self._db = sqlite3.connect(path, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS outbox ("
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "task TEXT, email TEXT, name TEXT, message TEXT, "
+                         "message_id, payload TEXT, source_url TEXT, "
+                         "icon TEXT, state INTEGER DEFAULT 0, "
+                         "status INTEGER, attempts INTEGER DEFAULT 0)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS outbox_state "
+                         "ON outbox (state, id)")
+        self._lock = threading.Lock()
+
+    def send(self, api, notifications, window=None):
+        """
+        Log and send notifications
+
+        @param api: the client sending the notifications
+        @type api: BoxcarApi
+        @param notifications: the notifications, each a dict of the
+                              arguments of notify or a tuple of them
+        @type notifications: iterable
+        @param window: Optional; the maximum number of requests in flight
+        @type window: int
+        @return: generator of (notification, result), result is True or
+                 the BoxcarException raised for it; the acknowledgements
+                 are written once per group, and for the results seen so
+                 far when the generator is closed early
+        """
+        _chunk = []
+        for _notification in notifications:
+            _chunk.append(_notification)
+            if (len(_chunk) >= self.COMMIT_SIZE):
+                for _item in self._closing(self._send_chunk(api, _chunk,
+                                                            window)):
+                    yield _item
+                _chunk = []
+        if (_chunk):
+            for _item in self._closing(self._send_chunk(api, _chunk,
+                                                        window)):
+                yield _item
+
+    def replay(self, api, window=None):
+        """
+        Send the notifications not acknowledged yet, oldest first
+
+        A 401 for a notification with a message_id counts as delivered,
+        as it is most likely the duplicate of a send that went out before
+        the acknowledgement was written.
+
+        @param api: the client sending the notifications
+        @type api: BoxcarApi
+        @param window: Optional; the maximum number of requests in flight
+        @type window: int
+        @return: generator of (notification dict, result)
+        """
+        _last = 0
+        while (True):
+            _rows = self._query(
+                "SELECT id, %s FROM outbox WHERE state = ? AND id > ? "
+                "ORDER BY id LIMIT ?" % ", ".join(self._COLUMNS),
+                (self.PENDING, _last, self.COMMIT_SIZE))
+            if (not _rows):
+                return
+            _last = _rows[-1][0]
+            _records = [(_row[0], dict(zip(self._COLUMNS, _row[1:])))
+                        for _row in _rows]
+            for ((_id, _values), _result) in self._closing(
+                    self._deliver(api, _records, window, True)):
+                yield (_values, _result)
+
+    def pending(self):
+        """
+        @return: the number of notifications not acknowledged yet
+        """
+        return self._query("SELECT COUNT(*) FROM outbox WHERE state = ?",
+                           (self.PENDING,))[0][0]
+
+    def close(self):
+        """ close the database """
+        self._db.close()
+
+    def _query(self, sql, args):
+        """ the rows of a query """
+        self._lock.acquire()
+        try:
+            return self._db.execute(sql, args).fetchall()
+        finally:
+            self._lock.release()
+
+    def _send_chunk(self, api, chunk, window):
+        """ log a chunk in one commit, then deliver it """
+        _records = []
+        self._lock.acquire()
+        try:
+            self._db.execute("BEGIN")
+            try:
+                for _notification in chunk:
+                    _values = self._values(_notification)
+                    _cursor = self._db.execute(
+                        "INSERT INTO outbox (%s) VALUES (%s)" % (
+                            ", ".join(self._COLUMNS),
+                            ", ".join("?" * len(self._COLUMNS))),
+                        [_values[_column] for _column in self._COLUMNS])
+                    _records.append((_cursor.lastrowid, _values))
+                self._db.execute("COMMIT")
+            except:
+                self._db.execute("ROLLBACK")
+                raise
+        finally:
+            self._lock.release()
+        _originals = dict((_records[i][0], chunk[i])
+                          for i in range(len(chunk)))
+        for ((_id, _values), _result) in self._closing(
+                self._deliver(api, _records, window, False)):
+            yield (_originals[_id], _result)
+
+    def _closing(self, generator):
+        """
+        Yield from generator, closing it when closed early, so the
+        acknowledgements of _deliver are written
+        """
+        try:
+            for _item in generator:
+                yield _item
+        finally:
+            generator.close()
+
+    def _deliver(self, api, records, window, replaying):
+        """
+        Send logged records, then acknowledge them in one commit
+
+        Closed early, it acknowledges the results seen so far; the
+        requests still in flight stay pending.
+
+        @return: generator of ((id, values), result)
+        """
+        _acks = []
+        _requests = (((_id, _values), _values["task"],
+                      api._encode_notification(*[_values[_column] for _column
+                                                 in self._COLUMNS[1:]]))
+                     for (_id, _values) in records)
+        try:
+            for ((_id, _values), _result) in api._send_stream(_requests,
+                                                              window):
+                if (_result is True):
+                    _acks.append((self.SENT, 200, _id))
+                elif (replaying and (_result.status_code == 401) and
+                        (_values["message_id"] is not None)):
+                    _acks.append((self.SENT, 401, _id))
+                elif (is_retryable(_result)):
+                    _acks.append((self.PENDING, _result.status_code, _id))
+                else:
+                    _acks.append((self.FAILED, _result.status_code, _id))
+                yield ((_id, _values), _result)
+        finally:
+            if (_acks):
+                self._acknowledge(_acks)
+
+    def _acknowledge(self, acks):
+        """ record the outcome of sends, in one commit """
+        self._lock.acquire()
+        try:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany("UPDATE outbox SET state = ?, "
+                                     "status = ?, attempts = attempts + 1 "
+                                     "WHERE id = ?", acks)
+                self._db.execute("COMMIT")
+            except:
+                self._db.execute("ROLLBACK")
+                raise
+        finally:
+            self._lock.release()
+
+    def _values(self, notification):
+        """ the column values of a notification given as dict or tuple """
+        if (not isinstance(notification, dict)):
+            notification = dict(zip(self._COLUMNS[1:], notification))
+        _values = dict.fromkeys(self._COLUMNS)
+        _values["task"] = "notifications"
+        _values.update(notification)
+        return _values
+
+
+class ClientRegistry(object):
+    """
+    Keeps a long-lived BoxcarApi per provider api key
+
+    The clients share the transport, rate limiter and stats collector of
+    the registry, so connections, the request budget and the stats are
+    pooled across requests and providers. Keep one per process, see
+    default_registry, and call warm_up() when the instance starts.
+    """
+
+    def __init__(self, transport=None, rate_limiter=None, stats=None,
+                 **options):
+        """
+        @param transport: Optional; shared by the clients,
+                          default_transport() if None
+        @type transport: UrlfetchTransport or HttpTransport
+        @param rate_limiter: Optional; shared by the clients
+        @type rate_limiter: TokenBucket
+        @param stats: Optional; observes the requests of every client,
+                      a new StatsCollector if None
+        @type stats: StatsCollector
+        @param options: other arguments of BoxcarApi given to every client
+        @type options: dict
+        """
+        if (transport is None):
+            transport = default_transport()
+        if (stats is None):
+            stats = StatsCollector()
+        self.transport = transport
+        self.rate_limiter = rate_limiter
+        self.stats = stats
+        self._options = options
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def register(self, api_key, secret, default_icon_url, **options):
+        """
+        Create the client of a provider, replacing the one registered
+        for api_key if any
+
+        @param api_key: the provider api key
+        @type api_key: str
+        @param secret: the provider api secret
+        @type secret: str
+        @param default_icon_url: url to a 57x57 icon to use with a message
+        @type default_icon_url: str
+        @param options: arguments of BoxcarApi overriding the shared ones
+        @type options: dict
+        @return: BoxcarApi
+        """
+        _options = dict(self._options)
+        _options.update(options)
+        _options.setdefault("transport", self.transport)
+        _options.setdefault("rate_limiter", self.rate_limiter)
+        _options["observers"] = ([self.stats] +
+                                 list(_options.get("observers") or ()))
+        _client = BoxcarApi(api_key, secret, default_icon_url, **_options)
+        self._lock.acquire()
+        try:
+            self._clients[api_key] = _client
+        finally:
+            self._lock.release()
+        return _client
+
+    def get(self, api_key):
+        """
+        The client of a provider
+
+        @param api_key: the provider api key
+        @type api_key: str
+        @return: BoxcarApi
+        """
+        _client = self._clients.get(api_key)
+        if (_client is None):
+            raise BoxcarException("No client registered for %s" % api_key)
+        return _client
+
+    def keys(self):
+        """
+        @return: list of the api keys registered
+        """
+        return self._clients.keys()
+
+    def warm_up(self, connections=1):
+        """
+        Open the connections of the clients ahead of the first request,
+        for transports keeping a pool
+
+        @param connections: the idle connections wanted per endpoint
+        @type connections: int
+        @return: the number of connections opened
+        """
+        _opened = 0
+        _warmed = set()
+        for _client in self._clients.values():
+            _warm = getattr(_client._transport, "warm", None)
+            _key = (id(_client._transport), _client.ENDPOINT)
+            if ((_warm is None) or (_key in _warmed)):
+                continue
+            _warmed.add(_key)
+            _opened += _warm(_client.ENDPOINT, connections)
+        return _opened
+
+
+## The HttpTransport shared by clients created off App Engine
+_shared_transport = None
+_shared_transport_lock = threading.Lock()
+
+
+def default_transport():
+    """
+    Return the transport used when none is given to BoxcarApi
+
+    @return: a UrlfetchTransport on App Engine, otherwise
+             a HttpTransport shared by all clients of the process
+    """
+    global _shared_transport
+    if (urlfetch is not None):
+        return UrlfetchTransport()
+    _shared_transport_lock.acquire()
+    try:
+        if (_shared_transport is None):
+            _shared_transport = HttpTransport()
+        return _shared_transport
+    finally:
+        _shared_transport_lock.release()
+
+
+## The ClientRegistry of the process
+_shared_registry = None
+_shared_registry_lock = threading.Lock()
+
+
+def default_registry():
+    """
+    Return the ClientRegistry shared by the whole process
+
+    @return: ClientRegistry, created with the default transport
+    """
+    global _shared_registry
+    _shared_registry_lock.acquire()
+    try:
+        if (_shared_registry is None):
+            _shared_registry = ClientRegistry()
+        return _shared_registry
+    finally:
+        _shared_registry_lock.release()
+
+
+## The arguments of notify, in order
+_NOTIFY_FIELDS = ("email", "name", "message", "message_id", "payload",
+                  "source_url", "icon")
+
+
+def _command_parser(usage):
+    """ option parser with the options common to every command """
+    _parser = optparse.OptionParser(usage=usage)
+    _parser.add_option("--key", default=os.environ.get("BOXCAR_API_KEY"),
+                       help="your api key, or $BOXCAR_API_KEY")
+    _parser.add_option("--secret", default=os.environ.get("BOXCAR_SECRET"),
+                       help="your api secret, or $BOXCAR_SECRET")
+    _parser.add_option("--icon", default=None,
+                       help="url of the default icon")
+    _parser.add_option("--window", type="int", default=None,
+                       help="requests in flight")
+    _parser.add_option("--endpoint", default=None,
+                       help="the endpoint for service, if not boxcar.io")
+    return _parser
+
+
+def _parse_command(parser, argv, nargs):
+    """ parse and check the options and the arguments after the command """
+    (_options, _args) = parser.parse_args(argv)
+    if (len(_args) != nargs):
+        parser.error("wrong number of arguments")
+    if ((not _options.key) or (not _options.secret)):
+        parser.error("--key and --secret are required")
+    return (_options, _args)
+
+
+def _count(counts, result):
+    """ count a result by status """
+    _key = "200"
+    if (result is not True):
+        _key = str(result.status_code or "error")
+    counts[_key] = counts.get(_key, 0) + 1
+
+
+def _replay_command(argv):
+    """ resend the notifications of an outbox not acknowledged yet """
+    _parser = _command_parser("%prog replay [options] OUTBOX")
+    (_options, _args) = _parse_command(_parser, argv, 1)
+    _api = BoxcarApi(_options.key, _options.secret, _options.icon,
+                     endpoint=_options.endpoint)
+    _outbox = Outbox(_args[0])
+    _counts = {}
+    try:
+        for (_notification, _result) in _outbox.replay(_api,
+                                                       _options.window):
+            _count(_counts, _result)
+        _counts["pending"] = _outbox.pending()
+    finally:
+        _outbox.close()
+    sys.stdout.write(json.dumps(_counts, sort_keys=True) + "\n")
+
+
+def read_notifications(path, defaults=None, shard=0, shards=1):
+    """
+    Read notifications from a CSV file with a header row, or from a
+    JSON lines file (.jsonl, .json), with the columns / keys email, name,
+    message, message_id, payload, source_url and icon
+
+    Shards split the file in byte ranges, a record belonging to the
+    range its line starts in, so each shard reads and parses only its
+    own part. Records must therefore be one per line: no line breaks
+    inside quoted CSV fields.
+
+    @param path: the file
+    @type path: str
+    @param defaults: Optional; values of the fields missing in the file
+    @type defaults: dict
+    @param shard: read only the shard-th of the shards byte ranges
+    @type shard: int
+    @param shards: the number of shards
+    @type shards: int
+    @return: generator of dicts of notify arguments
+    """
+    _file = open(path, "rb")
+    try:
+        _jsonl = os.path.splitext(path)[1] in (".jsonl", ".json")
+        _size = os.fstat(_file.fileno()).st_size
+        _header = None
+        if (not _jsonl):
+            _header = _file.readline()
+        _base = _file.tell()
+        _begin = _base + (_size - _base) * shard // shards
+        _end = _base + (_size - _base) * (shard + 1) // shards
+        if (_begin > _base):
+            # the line running into the range is the previous shard's
+            _file.seek(_begin - 1)
+            _file.readline()
+        _lines = _shard_lines(_file, _end)
+        if (_jsonl):
+            _records = (json.loads(_line) for _line in _lines
+                        if _line.strip())
+        else:
+            _fields = csv.reader([_header]).next()
+            _records = (dict((_key, _val.decode("utf-8"))
+                             for (_key, _val) in _record.iteritems()
+                             if _key and _val)
+                        for _record in csv.DictReader(_lines, _fields))
+        for _record in _records:
+            _notification = dict(defaults or {})
+            _notification.update((_key, _val)
+                                 for (_key, _val) in _record.iteritems()
+                                 if _key in _NOTIFY_FIELDS)
+            yield _notification
+    finally:
+        _file.close()
+
+
+def _shard_lines(fileobj, end):
+    """ the lines of fileobj starting before the offset end """
+    while (fileobj.tell() < end):
+        _line = fileobj.readline()
+        if (not _line):
+            return
+        yield _line
+
+
+def _send_shard(args):
+    """
+    Send one shard of a file, writing a result line per notification
+
+    @param args: (options dict, input path, shard, shards, result path)
+    @type args: tuple
+    @return: dict of the shard's stats
+    """
+    (_options, _path, _shard, _shards, _result_path) = args
+    _window = _options["window"] or BoxcarApi.DEFAULT_WINDOW
+    _transport = HttpTransport(max_connections=_window)
+    _api = BoxcarApi(_options["key"], _options["secret"], _options["icon"],
+                     transport=_transport, endpoint=_options["endpoint"])
+    _counts = {}
+    _start = time.time()
+    _out = open(_result_path, "wb")
+    try:
+        for (_notification, _result) in _api.notify_stream(
+                read_notifications(_path, _options["defaults"], _shard,
+                                   _shards), _window):
+            _count(_counts, _result)
+            _line = {"email": _notification.get("email"),
+                     "message_id": _notification.get("message_id"),
+                     "status": 200, "error": None}
+            if (_result is not True):
+                _line["status"] = _result.status_code
+                _line["error"] = _result.msg
+            _out.write(json.dumps(_line) + "\n")
+    finally:
+        _out.close()
+        _transport.close()
+    return {"shard": _shard, "seconds": time.time() - _start,
+            "notifications": sum(_counts.values()), "statuses": _counts}
+
+
+def _send_command(argv):
+    """ send every notification of a file from a pool of processes """
+    _parser = _command_parser("%prog send [options] INPUT")
+    _parser.add_option("--processes", type="int", default=None,
+                       help="worker processes, one per core by default")
+    _parser.add_option("--output-dir", default=".",
+                       help="where the result files are written")
+    _parser.add_option("--name", default=None,
+                       help="sender name of records without one")
+    _parser.add_option("--message", default=None,
+                       help="message of records without one")
+    (_options, _args) = _parse_command(_parser, argv, 1)
+    _shards = _options.processes or multiprocessing.cpu_count()
+    _defaults = {}
+    if (_options.name is not None):
+        _defaults["name"] = _options.name
+    if (_options.message is not None):
+        _defaults["message"] = _options.message
+    _common = {"key": _options.key, "secret": _options.secret,
+               "icon": _options.icon, "window": _options.window,
+               "endpoint": _options.endpoint, "defaults": _defaults}
+    _shard_paths = [os.path.join(_options.output_dir, "shard-%d.jsonl" % i)
+                    for i in range(_shards)]
+    _start = time.time()
+    _pool = multiprocessing.Pool(_shards)
+    try:
+        _stats = _pool.map(_send_shard, [(_common, _args[0], i, _shards,
+                                          _shard_paths[i])
+                                         for i in range(_shards)])
+    finally:
+        _pool.close()
+        _pool.join()
+    _elapsed = time.time() - _start
+    # merge the per shard results
+    _out = open(os.path.join(_options.output_dir, "results.jsonl"), "wb")
+    try:
+        for _shard_path in _shard_paths:
+            _in = open(_shard_path, "rb")
+            try:
+                shutil.copyfileobj(_in, _out)
+            finally:
+                _in.close()
+            os.remove(_shard_path)
+    finally:
+        _out.close()
+    _counts = {}
+    for _shard_stats in _stats:
+        for (_status, _number) in _shard_stats["statuses"].iteritems():
+            _counts[_status] = _counts.get(_status, 0) + _number
+    _total = sum(_counts.values())
+    _summary = {"notifications": _total, "statuses": _counts,
+                "seconds": _elapsed,
+                "throughput": _elapsed and _total / _elapsed or None,
+                "shards": _stats}
+    _file = open(os.path.join(_options.output_dir, "stats.json"), "wb")
+    try:
+        _file.write(json.dumps(_summary, indent=2, sort_keys=True) + "\n")
+    finally:
+        _file.close()
+    sys.stdout.write(json.dumps(_summary, sort_keys=True) + "\n")
+
+
+## The commands of main
+_COMMANDS = {"replay": _replay_command,
+             "send": _send_command}
+
+
+def main(argv=None):
+    """
+    Command line entry point
+
+        python -m boxcargae send [options] INPUT
+        python -m boxcargae replay [options] OUTBOX
+
+    send reads notifications from a CSV or JSON lines file and sends them
+    from a pool of processes, each with its own connection pool; the
+    results and stats are written to the output directory.
+    replay sends the notifications of an Outbox not acknowledged yet.
+    Run a command with --help for its options.
+    """
+    if (argv is None):
+        argv = sys.argv[1:]
+    if ((not argv) or (argv[0] not in _COMMANDS)):
+        sys.stderr.write("usage: python -m boxcargae {%s} [options] ...\n" %
+                         ",".join(sorted(_COMMANDS)))
+        sys.exit(2)
+    _COMMANDS[argv[0]](argv[1:])
+
+
+if __name__ == "__main__":
+    main()
@@ -9,21 +9,26 @@ from datetime import date, datetime
 from string import Template
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
-from boxcargae import BoxcarApi
+from boxcargae import (DeadlineScheduler, DeliveryWorker, TaskQueue,
+                       default_registry)
+
+_API_KEY = 'xxxxxxxxxxxxxxxxxxxx'
+_API_SEC = 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+_ICON_URL = 'http://xxxxx.xxxx.xx.xx.xx.xxxxxxxxx.xxx/xxxxxxxxxx.png'
+
+# one long-lived client per provider key, shared by every request
+_REGISTRY = default_registry()
+_REGISTRY.register(_API_KEY, _API_SEC, _ICON_URL,
+                   queue=TaskQueue('/_boxcar/deliver'))
 
 
 class TestBoxcar(webapp.RequestHandler):
     """test boxcar api class"""
     def get(self):
         """test boxcar api method"""
-        _api_key = 'xxxxxxxxxxxxxxxxxxxx'
-        _api_sec = 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
         _your_email = 'xxxxxxxxx@xxxxx.xxx'
-        # instantiate a new instance of the boxcar api
-        boxcar = BoxcarApi(_api_key,
-                           _api_sec,
-                           'http://xxxxx.xxxx.xx.xx.xx.xxxxxxxxx.xxx/'
-                           'xxxxxxxxxx.png')
+        # the boxcar api client of the provider
+        boxcar = _REGISTRY.get(_API_KEY)
         # send a broadcast (to all your subscribers)
         template = Template('Test Broadcast, this was sent at $date')
         message = template.substitute(date=date.today())
@@ -35,10 +40,34 @@ class TestBoxcar(webapp.RequestHandler):
                       'Test name',
                       message,
                       message_id=int(datetime.now().strftime('%f')) % 1000)
+        # queue a message, it is sent by BoxcarDeliver in the background
+        boxcar.enqueue_notify(_your_email, 'Test name', 'Queued message')
+        boxcar.flush()
+        # send within 5 seconds, what does not fit is queued
+        scheduler = DeadlineScheduler(boxcar, 5.0)
+        for (_notification, path, result) in scheduler.send(
+                [(_your_email, 'Test name', 'Scheduled message')]):
+            logging.debug("scheduled message %s: %s", path, result)
+
+
+class BoxcarDeliver(webapp.RequestHandler):
+    """delivers the notifications queued by enqueue_notify"""
+    def post(self):
+        """send one queued batch"""
+        DeliveryWorker(_REGISTRY.get(_API_KEY)).handle(self.request.body)
+
+
+class Warmup(webapp.RequestHandler):
+    """prepares the boxcar clients when the instance starts"""
+    def get(self):
+        """open the connections ahead of the first request"""
+        _REGISTRY.warm_up()
 
 
 logging.getLogger().setLevel(logging.DEBUG)
-_APPLICATION = webapp.WSGIApplication([("/.*", TestBoxcar)],
+_APPLICATION = webapp.WSGIApplication([("/_ah/warmup", Warmup),
+                                       ("/_boxcar/deliver", BoxcarDeliver),
+                                       ("/.*", TestBoxcar)],
                                       debug=True)
 
 
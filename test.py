@@ -4,10 +4,16 @@
 unit test for boxcargae
 """
 
+import os
+import shutil
+import tempfile
 import unittest
+import threading
+import BaseHTTPServer
 from minimock import mock, restore, Mock, TraceTracker, assert_same_trace
 import google.appengine.api
 import boxcargae
+import boxcarfake
 
 
 class Response(object):
@@ -17,6 +23,17 @@ class Response(object):
         self.status_code = code
 
 
+class RPC(object):
+    """ urlfetch rpc returning a fixed responce """
+    def __init__(self, code):
+        """ make dummy rpc """
+        self.response = Response(code)
+
+    def get_result(self):
+        """ return dummy responce """
+        return self.response
+
+
 class TestBoxcarGAE(unittest.TestCase):
     """ test BoxcarGAE """
     def setUp(self):
@@ -63,11 +80,11 @@ class TestiBoxcarGAENormal(TestBoxcarGAE):
             "    'http://boxcar.io/devices/providers/xxxxxxxxxxxxxxxxxxxx/notifications/broadcast',\n"
             "    headers={'User-Agent': 'Boxcar_Client'},\n"
             "    method='POST',\n"
-            "    payload='secret=xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx&"
+            "    payload='token=xxxxxxxxxxxxxxxxxxxx&"
+                         "secret=xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx&"
+                         "notification%5Bfrom_screen_name%5D=test_normal&"
                          "notification%5Bmessage%5D=broadcast+message&"
-                         "notification%5Bicon_url%5D=xxxxxxxxx%40xxxxx.xxx&"
-                         "token=xxxxxxxxxxxxxxxxxxxx&"
-                         "notification%5Bfrom_screen_name%5D=test_normal')\n")
+                         "notification%5Bicon_url%5D=xxxxxxxxx%40xxxxx.xxx')\n")
 
     def test_notify(self):
         # mock urlfetch
@@ -87,13 +104,23 @@ class TestiBoxcarGAENormal(TestBoxcarGAE):
             "    'http://boxcar.io/devices/providers/xxxxxxxxxxxxxxxxxxxx/notifications',\n"
             "    headers={'User-Agent': 'Boxcar_Client'},\n"
             "    method='POST',\n"
-            "    payload='notification%5Bfrom_remote_service_id%5D=200&"
-                         "notification%5Bicon_url%5D=xxxxxxxxx%40xxxxx.xxx&"
+            "    payload='token=xxxxxxxxxxxxxxxxxxxx&"
                          "secret=xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx&"
-                         "token=xxxxxxxxxxxxxxxxxxxx&"
-                         "notification%5Bmessage%5D=notification+message&"
                          "email=fd2504c1a700746932666efec57e4b92&"
-                         "notification%5Bfrom_screen_name%5D=test_normal')\n")
+                         "notification%5Bfrom_screen_name%5D=test_normal&"
+                         "notification%5Bmessage%5D=notification+message&"
+                         "notification%5Bfrom_remote_service_id%5D=200&"
+                         "notification%5Bicon_url%5D=xxxxxxxxx%40xxxxx.xxx')\n")
+
+    def test_md5_cache(self):
+        # digests are cached and the cache is bounded
+        self.boxcar._md5_cache = boxcargae._LRUCache(2)
+        for email in ['a@a.aa', 'b@b.bb', 'a@a.aa', 'c@c.cc']:
+            self.boxcar._md5_email(email)
+        self.assertEqual(len(self.boxcar._md5_cache), 2)
+        self.assertEqual(self.boxcar._md5_cache.get('b@b.bb'), None)
+        self.assertEqual(self.boxcar._md5_email(u'yyyyyyyy@yyyyy.yyy'),
+                         'fd2504c1a700746932666efec57e4b92')
 
 
 class TestiBoxcarGAEError(TestBoxcarGAE):
@@ -136,13 +163,13 @@ class TestiBoxcarGAEError(TestBoxcarGAE):
             "    'http://boxcar.io/devices/providers/xxxxxxxxxxxxxxxxxxxx/notifications',\n"
             "    headers={'User-Agent': 'Boxcar_Client'},\n"
             "    method='POST',\n"
-            "    payload='notification%5Bfrom_remote_service_id%5D=400&"
-                         "notification%5Bicon_url%5D=xxxxxxxxx%40xxxxx.xxx&"
+            "    payload='token=xxxxxxxxxxxxxxxxxxxx&"
                          "secret=xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx&"
-                         "token=xxxxxxxxxxxxxxxxxxxx&"
-                         "notification%5Bmessage%5D=notification+error&"
                          "email=fd2504c1a700746932666efec57e4b92&"
-                         "notification%5Bfrom_screen_name%5D=test_error')\n")
+                         "notification%5Bfrom_screen_name%5D=test_error&"
+                         "notification%5Bmessage%5D=notification+error&"
+                         "notification%5Bfrom_remote_service_id%5D=400&"
+                         "notification%5Bicon_url%5D=xxxxxxxxx%40xxxxx.xxx')\n")
 
     def test_request_failure(self):
         # mock urlfetch
@@ -163,13 +190,13 @@ class TestiBoxcarGAEError(TestBoxcarGAE):
             "    'http://boxcar.io/devices/providers/xxxxxxxxxxxxxxxxxxxx/notifications',\n"
             "    headers={'User-Agent': 'Boxcar_Client'},\n"
             "    method='POST',\n"
-            "    payload='notification%5Bfrom_remote_service_id%5D=401&"
-                         "notification%5Bicon_url%5D=xxxxxxxxx%40xxxxx.xxx&"
+            "    payload='token=xxxxxxxxxxxxxxxxxxxx&"
                          "secret=xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx&"
-                         "token=xxxxxxxxxxxxxxxxxxxx&"
-                         "notification%5Bmessage%5D=notification+error&"
                          "email=fd2504c1a700746932666efec57e4b92&"
-                         "notification%5Bfrom_screen_name%5D=test_error')\n")
+                         "notification%5Bfrom_screen_name%5D=test_error&"
+                         "notification%5Bmessage%5D=notification+error&"
+                         "notification%5Bfrom_remote_service_id%5D=401&"
+                         "notification%5Bicon_url%5D=xxxxxxxxx%40xxxxx.xxx')\n")
 
     def test_request_failure_403(self):
         # mock urlfetch
@@ -190,13 +217,13 @@ class TestiBoxcarGAEError(TestBoxcarGAE):
             "    'http://boxcar.io/devices/providers/xxxxxxxxxxxxxxxxxxxx/notifications',\n"
             "    headers={'User-Agent': 'Boxcar_Client'},\n"
             "    method='POST',\n"
-            "    payload='notification%5Bfrom_remote_service_id%5D=403&"
-                         "notification%5Bicon_url%5D=xxxxxxxxx%40xxxxx.xxx&"
+            "    payload='token=xxxxxxxxxxxxxxxxxxxx&"
                          "secret=xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx&"
-                         "token=xxxxxxxxxxxxxxxxxxxx&"
-                         "notification%5Bmessage%5D=notification+error&"
                          "email=fd2504c1a700746932666efec57e4b92&"
-                         "notification%5Bfrom_screen_name%5D=test_error')\n")
+                         "notification%5Bfrom_screen_name%5D=test_error&"
+                         "notification%5Bmessage%5D=notification+error&"
+                         "notification%5Bfrom_remote_service_id%5D=403&"
+                         "notification%5Bicon_url%5D=xxxxxxxxx%40xxxxx.xxx')\n")
 
     def test_unknown_error(self):
         # mock urlfetch
@@ -217,13 +244,1167 @@ class TestiBoxcarGAEError(TestBoxcarGAE):
             "    'http://boxcar.io/devices/providers/xxxxxxxxxxxxxxxxxxxx/notifications',\n"
             "    headers={'User-Agent': 'Boxcar_Client'},\n"
             "    method='POST',\n"
-            "    payload='notification%5Bfrom_remote_service_id%5D=500&"
-                         "notification%5Bicon_url%5D=xxxxxxxxx%40xxxxx.xxx&"
+            "    payload='token=xxxxxxxxxxxxxxxxxxxx&"
                          "secret=xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx&"
-                         "token=xxxxxxxxxxxxxxxxxxxx&"
-                         "notification%5Bmessage%5D=unknown+error&"
                          "email=fd2504c1a700746932666efec57e4b92&"
-                         "notification%5Bfrom_screen_name%5D=test_error')\n")
+                         "notification%5Bfrom_screen_name%5D=test_error&"
+                         "notification%5Bmessage%5D=unknown+error&"
+                         "notification%5Bfrom_remote_service_id%5D=500&"
+                         "notification%5Bicon_url%5D=xxxxxxxxx%40xxxxx.xxx')\n")
+
+
+class TestBoxcarGAEMany(TestBoxcarGAE):
+    """ notify_many cases class """
+    def test_notify_many(self):
+        # mock urlfetch, one rpc per recipient
+        trace = TraceTracker()
+        rpcs = [RPC(200), RPC(401), RPC(200)]
+        boxcargae.urlfetch = Mock('boxcargae.urlfetch')
+        boxcargae.urlfetch.Error = Exception
+        boxcargae.urlfetch.create_rpc = lambda *args, **kw: rpcs.pop(0)
+        boxcargae.urlfetch.make_fetch_call = Mock('make_fetch_call',
+                                                  tracker=trace)
+        results = self.boxcar.notify_many(['a@a.aa', 'b@b.bb', 'c@c.cc'],
+                                          'test_many', 'many message',
+                                          window=2)
+        self.assertEqual([email for (email, result) in results],
+                         ['a@a.aa', 'b@b.bb', 'c@c.cc'])
+        self.assertEqual(results[0][1], True)
+        self.assert_(isinstance(results[1][1], boxcargae.BoxcarException))
+        self.assertEqual(results[2][1], True)
+        self.assertEqual(trace.dump().count('Called make_fetch_call('), 3)
+
+    def test_start_failure(self):
+        # requests failing to start are results, not an abort
+        def make_fetch_call(*args, **kw):
+            raise boxcargae.urlfetch.Error('connection refused')
+        boxcargae.urlfetch = Mock('boxcargae.urlfetch')
+        boxcargae.urlfetch.Error = ValueError
+        boxcargae.urlfetch.create_rpc = lambda *args, **kw: RPC(200)
+        boxcargae.urlfetch.make_fetch_call = make_fetch_call
+        stats = boxcargae.StatsCollector()
+        self.boxcar.add_observer(stats)
+        results = self.boxcar.notify_many(['a@a.aa', 'b@b.bb'], 'test_many',
+                                          'many message')
+        self.assertEqual([isinstance(result, boxcargae.BoxcarTransportError)
+                          for (email, result) in results], [True, True])
+        self.assertEqual(stats.as_dict()['notifications']['in_flight'], 0)
+        self.assertEqual(stats.as_dict()['notifications']['statuses'],
+                         {'error': 2})
+
+    def test_notify_stream(self):
+        # notifications are pulled lazily, window by window
+        transport = StatusTransport(200, 404, 200)
+        boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                                     'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                                     'xxxxxxxxx@xxxxx.xxx',
+                                     transport=transport)
+        pulled = []
+
+        def notifications():
+            for i in range(1000):
+                pulled.append(i)
+                if (i % 2):
+                    yield ('user%d@a.aa' % i, 'test_stream', 'message')
+                else:
+                    yield {'email': 'user%d@a.aa' % i, 'name': 'test_stream',
+                           'message': 'message', 'message_id': i}
+        stream = boxcar.notify_stream(notifications(), window=2)
+        (notification, result) = stream.next()
+        self.assertEqual(notification['email'], 'user0@a.aa')
+        self.assertEqual(result, True)
+        self.assertEqual(len(pulled), 3)
+        (notification, result) = stream.next()
+        self.assertEqual(notification[0], 'user1@a.aa')
+        self.assertEqual(result.status_code, 404)
+        self.assertEqual(len([r for (n, r) in stream if r is True]), 998)
+
+    def test_promotion(self):
+        # recipients covering the audience get one broadcast
+        transport = StatusTransport(200)
+        audience = ['a@a.aa', 'b@b.bb', 'c@c.cc']
+        boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                                     'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                                     'xxxxxxxxx@xxxxx.xxx',
+                                     transport=transport,
+                                     audience=lambda: audience)
+        results = boxcar.notify_many(['d@d.dd'] + audience, 'test_many',
+                                     'many message')
+        self.assertEqual(results, [('d@d.dd', True), ('a@a.aa', True),
+                                   ('b@b.bb', True), ('c@c.cc', True)])
+        self.assertEqual(len(transport.payloads), 2)
+        self.assert_('email' not in transport.payloads[0])
+        self.assert_(boxcar._md5_email('d@d.dd') in transport.payloads[1])
+        self.assertEqual(boxcar.promotions, 1)
+        # short of the fraction, every recipient is notified
+        boxcar.notify_many(audience[:2], 'test_many', 'many message')
+        self.assertEqual(len(transport.payloads), 4)
+        # a lower fraction is opted into per client
+        boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                                     'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                                     'xxxxxxxxx@xxxxx.xxx',
+                                     transport=transport,
+                                     audience=lambda: audience,
+                                     promote_fraction=0.6)
+        boxcar.notify_many(audience[:2], 'test_many', 'many message')
+        self.assertEqual(len(transport.payloads), 5)
+        self.assertEqual(boxcar.promotions, 1)
+
+
+class StatusTransport(object):
+    """ transport answering with scripted status codes """
+    def __init__(self, *codes):
+        """ codes are used in turn, the last one repeats """
+        self.codes = list(codes)
+        self.payloads = []
+        self.deadlines = []
+
+    def fetch(self, url, payload, headers, deadline=None):
+        """ record the payload and answer the next code """
+        self.payloads.append(payload)
+        self.deadlines.append(deadline)
+        if (len(self.codes) > 1):
+            return Response(self.codes.pop(0))
+        return Response(self.codes[0])
+
+    def fetch_async(self, url, payload, headers, deadline=None):
+        """ as fetch, already done """
+        return RPC(self.fetch(url, payload, headers, deadline).status_code)
+
+    def close(self):
+        """ nothing to close """
+
+
+class TestBoxcarGAEQueue(unittest.TestCase):
+    """ enqueue / DeliveryWorker cases class """
+    def setUp(self):
+        self.queue = boxcargae.MemoryQueue()
+        self.transport = StatusTransport(200)
+        self.boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxx@xxxxx.xxx',
+                           transport=self.transport,
+                           queue=self.queue)
+        self.boxcar.BATCH_SIZE = 2
+        self.worker = boxcargae.DeliveryWorker(self.boxcar, max_attempts=2)
+
+    def test_batches(self):
+        # a full batch is written at once, the rest on flush
+        for email in ['a@a.aa', 'b@b.bb', 'c@c.cc']:
+            self.boxcar.enqueue_notify(email, 'test_queue', 'queued message')
+        self.assertEqual(len(self.queue.tasks), 1)
+        self.boxcar.enqueue_broadcast('test_queue', 'queued broadcast')
+        self.assertEqual(len(self.queue.tasks), 2)
+        self.assertEqual(self.boxcar.flush(), 0)
+        self.assertEqual(self.queue.run(self.worker), 2)
+        self.assertEqual(len(self.transport.payloads), 4)
+
+    def test_retry(self):
+        # only the failed notification is retried, then dropped
+        self.transport.codes = [200, 500, 500, 200]
+        self.boxcar.enqueue_notify('a@a.aa', 'test_queue', 'queued message')
+        self.boxcar.enqueue_notify('b@b.bb', 'test_queue', 'queued message')
+        self.queue.run(self.worker)
+        self.assertEqual(len(self.queue.tasks), 1)
+        countdown = self.queue.tasks[0][0]
+        self.assert_(self.worker.BACKOFF_BASE / 2 <= countdown <=
+                     self.worker.BACKOFF_BASE)
+        self.queue.run(self.worker)
+        self.assertEqual(self.queue.tasks, [])
+        self.assertEqual(len(self.transport.payloads), 3)
+
+    def test_no_queue(self):
+        boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                                     'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                                     'xxxxxxxxx@xxxxx.xxx')
+        self.assertRaises(boxcargae.BoxcarException,
+                          boxcar.enqueue_broadcast, 'test_queue', 'message')
+
+
+class TestBoxcarGAERate(unittest.TestCase):
+    """ TokenBucket / AimdController cases class """
+    def test_token_bucket(self):
+        # the burst is available at once, then the rate applies
+        bucket = boxcargae.TokenBucket(1000, burst=3)
+        self.assert_(bucket.try_acquire(3))
+        self.failIf(bucket.try_acquire(3))
+        self.assert_(bucket.acquire(3) > 0)
+
+    def test_aimd(self):
+        # one decrease per window of failures, slow growth on success
+        controller = boxcargae.AimdController(initial=8, maximum=9)
+        for code in [403] * 8:
+            controller.on_status(code)
+        self.assertEqual(controller.window, 4)
+        controller.on_status(500)
+        self.assertEqual(controller.window, 4)
+        for code in [200] * 8:
+            controller.on_status(code)
+        self.assertEqual(controller.window, 5)
+        controller.on_status(401)
+        self.assertEqual(controller.window, 5)
+
+    def test_client(self):
+        # bulk sends feed the controller and take tokens
+        controller = boxcargae.AimdController(initial=4)
+        # a token a second cannot refill the 4 taken while the test runs
+        bucket = boxcargae.TokenBucket(1, burst=10)
+        boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                                     'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                                     'xxxxxxxxx@xxxxx.xxx',
+                                     transport=StatusTransport(503),
+                                     rate_limiter=bucket,
+                                     concurrency=controller)
+        boxcar.notify_many(['a@a.aa', 'b@b.bb', 'c@c.cc', 'd@d.dd'],
+                           'test_rate', 'rate message')
+        self.assertEqual(controller.window, 2)
+        self.failIf(bucket.try_acquire(9))
+        self.assert_(bucket.try_acquire(6))
+
+
+class TestBoxcarGAEDedup(unittest.TestCase):
+    """ Deduplicator cases class """
+    def setUp(self):
+        self.transport = StatusTransport(200)
+        self.dedup = boxcargae.Deduplicator(boxcargae.LocalStore(ttl=60))
+        self.boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxx@xxxxx.xxx',
+                           transport=self.transport,
+                           dedup=self.dedup)
+
+    def test_duplicate(self):
+        # the second send of an id fails without a request
+        self.boxcar.notify('a@a.aa', 'test_dedup', 'message', message_id=1)
+        self.boxcar.notify('b@b.bb', 'test_dedup', 'message', message_id=1)
+        try:
+            self.boxcar.notify('a@a.aa', 'test_dedup', 'message',
+                               message_id=1)
+            self.fail()
+        except boxcargae.BoxcarException, e:
+            self.assertEqual(e.status_code, 401)
+        self.assertEqual(len(self.transport.payloads), 2)
+        self.assertEqual(self.dedup.stats(), {"hits": 1, "misses": 2})
+
+    def test_failed_not_marked(self):
+        # a failed send may be tried again
+        self.transport.codes = [500, 200]
+        self.assertRaises(boxcargae.BoxcarException, self.boxcar.broadcast,
+                          'test_dedup', 'message', message_id=2)
+        self.assertEqual(self.boxcar.broadcast('test_dedup', 'message',
+                                               message_id=2), True)
+
+    def test_expired(self):
+        store = boxcargae.LocalStore(ttl=-1)
+        store.set('key', 1)
+        self.assertEqual(store.get('key'), None)
+
+    def test_memcache(self):
+        # the shared store goes through the memcache client
+        trace = TraceTracker()
+        client = Mock('memcache', tracker=None)
+        client.get = Mock('get', returns=None, tracker=trace)
+        client.set = Mock('set', returns=True, tracker=trace)
+        store = boxcargae.MemcacheStore(client, ttl=30)
+        self.assertEqual(store.get('key'), None)
+        store.set('key', 1)
+        assert_same_trace(trace,
+            "Called get('boxcar:key')\n"
+            "Called set('boxcar:key', 1, time=30)\n")
+
+
+class TestBoxcarGAEStats(unittest.TestCase):
+    """ observer / StatsCollector cases class """
+    def setUp(self):
+        self.transport = StatusTransport(200, 401, 200)
+        self.stats = boxcargae.StatsCollector()
+        self.boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxx@xxxxx.xxx',
+                           transport=self.transport,
+                           observers=[self.stats])
+
+    def test_observer(self):
+        # the observer hears about both ends of every request
+        trace = TraceTracker()
+        observer = Mock('observer', tracker=None)
+        observer.before_request = Mock('before_request', tracker=trace)
+        observer.after_request = Mock('after_request', tracker=trace)
+        self.transport.codes = [200]
+        self.boxcar.add_observer(observer)
+        self.boxcar.broadcast('test_stats', 'message')
+        self.boxcar.remove_observer(observer)
+        self.boxcar.broadcast('test_stats', 'message')
+        assert_same_trace(trace,
+            "Called before_request('notifications/broadcast', 203)\n"
+            "Called after_request('notifications/broadcast', 203, ..., 200)\n")
+
+    def test_stats(self):
+        # counts, statuses and latencies per task
+        self.boxcar.notify_many(['a@a.aa', 'b@b.bb'], 'test_stats', 'message')
+        self.boxcar.broadcast('test_stats', 'message')
+        stats = self.stats.as_dict()
+        self.assertEqual(sorted(stats.keys()),
+                         ['notifications', 'notifications/broadcast'])
+        self.assertEqual(stats['notifications']['requests'], 2)
+        self.assertEqual(stats['notifications']['in_flight'], 0)
+        self.assertEqual(stats['notifications']['statuses'],
+                         {'200': 1, '401': 1})
+        self.assert_(stats['notifications']['latency_p99'] >= 0)
+        body = self.stats({}, lambda status, headers: None)
+        self.assertEqual(boxcargae.json.loads(body[0]), stats)
+
+
+class TestBoxcarGAEBreaker(unittest.TestCase):
+    """ CircuitBreaker cases class """
+    def setUp(self):
+        self.transport = StatusTransport(500)
+        self.breaker = boxcargae.CircuitBreaker(failure_threshold=2,
+                                                reset_timeout=60)
+        self.boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxx@xxxxx.xxx',
+                           transport=self.transport,
+                           breaker=self.breaker)
+
+    def test_open(self):
+        # consecutive failures open the circuit, then calls fail fast
+        for i in range(2):
+            self.assertRaises(boxcargae.BoxcarException,
+                              self.boxcar.broadcast, 'test_breaker', 'message')
+        self.assertEqual(self.breaker.state, boxcargae.CircuitBreaker.OPEN)
+        self.assertRaises(boxcargae.BoxcarCircuitOpen,
+                          self.boxcar.broadcast, 'test_breaker', 'message')
+        results = self.boxcar.notify_many(['a@a.aa'], 'test_breaker', 'm')
+        self.assert_(isinstance(results[0][1], boxcargae.BoxcarCircuitOpen))
+        self.assertEqual(len(self.transport.payloads), 2)
+
+    def test_half_open(self):
+        # a single trial request closes the circuit again
+        for code in [500, 500]:
+            self.breaker.record(code)
+        self.breaker.reset_timeout = 0
+        self.assert_(self.breaker.allow())
+        self.breaker.reset_timeout = 60
+        self.failIf(self.breaker.allow())
+        self.breaker.record(200)
+        self.assertEqual(self.breaker.state, boxcargae.CircuitBreaker.CLOSED)
+
+    def test_lost_trial(self):
+        # a trial never collected is replaced after reset_timeout
+        boxcar = boxcargae.AsyncBoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxx@xxxxx.xxx',
+                           transport=StatusTransport(200),
+                           breaker=self.breaker)
+        for code in [500, 500]:
+            self.breaker.record(code)
+        self.breaker.reset_timeout = 0
+        boxcar.notify_async('a@a.aa', 'test_breaker', 'never waited')
+        self.assertEqual(self.breaker.state,
+                         boxcargae.CircuitBreaker.HALF_OPEN)
+        self.assertEqual(boxcar.notify('a@a.aa', 'test_breaker', 'm'), True)
+        self.assertEqual(self.breaker.state, boxcargae.CircuitBreaker.CLOSED)
+
+    def test_trial_start_failure(self):
+        # a trial failing to start opens the circuit again
+        self.boxcar._transport = TimeoutTransport(200)
+        for code in [500, 500]:
+            self.breaker.record(code)
+        self.breaker.reset_timeout = 0
+        self.boxcar.notify_many(['a@a.aa'], 'test_breaker', 'm')
+        self.breaker.reset_timeout = 60
+        self.assertEqual(self.breaker.state, boxcargae.CircuitBreaker.OPEN)
+
+    def test_error_rate(self):
+        breaker = boxcargae.CircuitBreaker(failure_threshold=10,
+                                           error_rate=0.5, window=4)
+        for code in [200, 500, 200, 500]:
+            breaker.record(code)
+        self.assertEqual(breaker.state, boxcargae.CircuitBreaker.OPEN)
+
+    def test_divert(self):
+        # with a queue, notifications are queued while the circuit is open
+        queue = boxcargae.MemoryQueue()
+        self.boxcar._queue = queue
+        for code in [500, 500]:
+            self.breaker.record(code)
+        for email in ['a@a.aa', 'b@b.bb', 'c@c.cc']:
+            self.assertEqual(self.boxcar.notify(email, 'test_breaker', 'm'),
+                             False)
+        self.assertEqual(len(queue.tasks), 3)
+        self.assertEqual(self.boxcar.flush(), 0)
+
+
+class TestBoxcarGAECoalescer(unittest.TestCase):
+    """ NotificationCoalescer cases class """
+    def setUp(self):
+        self.transport = StatusTransport(200)
+        self.boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxx@xxxxx.xxx',
+                           transport=self.transport)
+        self.coalescer = boxcargae.NotificationCoalescer(self.boxcar,
+                                                         window=60,
+                                                         max_count=3)
+
+    def test_max_count(self):
+        # the third message sends the combined notification
+        self.assertEqual(self.coalescer.notify('a@a.aa', 'src', 'one'), [])
+        self.coalescer.notify('b@b.bb', 'src', 'other')
+        self.coalescer.notify('a@a.aa', 'src', 'two')
+        self.assertEqual(self.coalescer.notify('a@a.aa', 'src', 'three'),
+                         [(('a@a.aa', 'src'), True)])
+        self.assertEqual(len(self.transport.payloads), 1)
+        self.assert_('notification%5Bmessage%5D=3+messages%3A%0Aone%0Atwo'
+                     '%0Athree' in self.transport.payloads[0])
+        self.assertEqual(len(self.coalescer), 1)
+
+    def test_window(self):
+        # expired buffers are sent, a single message as it is
+        self.coalescer.notify('a@a.aa', 'src', 'one', message_id=7)
+        self.coalescer.window = 0
+        self.assertEqual(self.coalescer.flush_expired(),
+                         [(('a@a.aa', 'src'), True)])
+        self.assert_('notification%5Bmessage%5D=one&'
+                     'notification%5Bfrom_remote_service_id%5D=7'
+                     in self.transport.payloads[0])
+
+    def test_flush(self):
+        # flush sends everything with a custom formatter
+        coalescer = boxcargae.NotificationCoalescer(
+            self.boxcar, formatter=lambda messages: messages[-1])
+        coalescer.notify('a@a.aa', 'src', 'one')
+        coalescer.notify('a@a.aa', 'src', 'two')
+        self.assertEqual(len(coalescer.flush()), 1)
+        self.assertEqual(len(coalescer), 0)
+        self.assert_('notification%5Bmessage%5D=two&'
+                     in self.transport.payloads[0])
+
+
+class TimeoutTransport(StatusTransport):
+    """ transport timing out on every request """
+    def fetch(self, url, payload, headers, deadline=None):
+        """ record the payload and time out """
+        StatusTransport.fetch(self, url, payload, headers, deadline)
+        raise boxcargae.BoxcarTransportError("Deadline exceeded")
+
+
+class TestBoxcarGAEDeadline(unittest.TestCase):
+    """ DeadlineScheduler cases class """
+    def setUp(self):
+        self.queue = boxcargae.MemoryQueue()
+        self.transport = StatusTransport(200, 404, 200)
+        self.boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxx@xxxxx.xxx',
+                           transport=self.transport,
+                           queue=self.queue)
+        self.notifications = [('a@a.aa', 'src', 'one'),
+                              {'email': 'b@b.bb', 'name': 'src',
+                               'message': 'two', 'message_id': 2}]
+
+    def test_inline(self):
+        # sends fit in the budget, deadlines are capped
+        scheduler = boxcargae.DeadlineScheduler(self.boxcar, 30)
+        results = scheduler.send(self.notifications)
+        self.assertEqual([(path, result is True)
+                          for (notification, path, result) in results],
+                         [('inline', True), ('inline', False)])
+        self.assertEqual(results[1][2].status_code, 404)
+        self.assertEqual(self.transport.deadlines, [10.0, 10.0])
+        self.assertEqual(self.queue.tasks, [])
+
+    def test_spill(self):
+        # short deadlines, then the rest is queued
+        scheduler = boxcargae.DeadlineScheduler(self.boxcar, 2.0)
+        self.assertEqual([path for (notification, path, result)
+                          in scheduler.send(self.notifications * 2)],
+                         ['inline'] * 4)
+        self.assert_(self.transport.deadlines[0] <= 1.5)
+        scheduler.budget = 1.0
+        results = scheduler.send(self.notifications)
+        self.assertEqual([path for (notification, path, result) in results],
+                         ['queued', 'queued'])
+        self.assertEqual(len(self.queue.tasks), 1)
+        entries = boxcargae.json.loads(self.queue.tasks[0][1])
+        self.assertEqual([(entry['email'], entry['message_id'])
+                          for entry in entries],
+                         [('a@a.aa', None), ('b@b.bb', 2)])
+
+    def test_timeout(self):
+        # a timed out send and all after it are queued
+        transport = TimeoutTransport(200)
+        self.boxcar._transport = transport
+        scheduler = boxcargae.DeadlineScheduler(self.boxcar, 30)
+        self.assertEqual([path for (notification, path, result)
+                          in scheduler.send(self.notifications)],
+                         ['queued', 'queued'])
+        self.assertEqual(len(transport.payloads), 1)
+        self.assertEqual(len(self.queue.tasks), 1)
+
+    def test_rate_limited(self):
+        # no rate limiter token within the budget spills to the queue
+        self.boxcar._rate_limiter = boxcargae.TokenBucket(0.1, burst=1)
+        scheduler = boxcargae.DeadlineScheduler(self.boxcar, 2.0,
+                                                reserve=0.5,
+                                                min_deadline=0.1)
+        start = boxcargae.time.time()
+        self.assertEqual([path for (notification, path, result)
+                          in scheduler.send(self.notifications)],
+                         ['inline', 'queued'])
+        self.assert_(boxcargae.time.time() - start < 1.5)
+        self.assertEqual(len(self.transport.payloads), 1)
+
+    def test_limiter_overrun(self):
+        # a limiter wait using up the deadline ends the request unsent
+        stats = boxcargae.StatsCollector()
+        self.boxcar.add_observer(stats)
+        self.boxcar._rate_limiter = OverrunLimiter()
+        scheduler = boxcargae.DeadlineScheduler(self.boxcar, 2.0,
+                                                reserve=0.5,
+                                                min_deadline=0.1)
+        self.assertEqual([path for (notification, path, result)
+                          in scheduler.send(self.notifications)],
+                         ['queued', 'queued'])
+        self.assertEqual(self.transport.payloads, [])
+        self.assertEqual(stats.as_dict()['notifications']['in_flight'], 0)
+
+    def test_no_queue(self):
+        self.boxcar._queue = None
+        self.assertRaises(boxcargae.BoxcarException,
+                          boxcargae.DeadlineScheduler, self.boxcar, 30)
+
+
+class OverrunLimiter(object):
+    """ rate limiter whose wait runs past the time it reports """
+    def acquire(self, tokens=1, timeout=None):
+        boxcargae.time.sleep(timeout + 0.01)
+        return timeout
+
+
+class BlockingTransport(StatusTransport):
+    """ transport holding the first request until released """
+    def __init__(self, *codes):
+        StatusTransport.__init__(self, *codes)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def fetch(self, url, payload, headers, deadline=None):
+        """ wait for release on the first request """
+        if (not self.started.isSet()):
+            self.started.set()
+            self.release.wait(5)
+        return StatusTransport.fetch(self, url, payload, headers, deadline)
+
+
+class TestBoxcarGAEPriority(unittest.TestCase):
+    """ PriorityDispatcher cases class """
+    def setUp(self):
+        self.transport = BlockingTransport(200)
+        self.boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxx@xxxxx.xxx',
+                           transport=self.transport)
+
+    def messages(self):
+        return [payload.split('notification%5Bmessage%5D=')[1].split('&')[0]
+                for payload in self.transport.payloads]
+
+    def test_preempt(self):
+        # queued interactive work goes ahead of queued bulk work
+        dispatcher = boxcargae.PriorityDispatcher(
+            self.boxcar, lanes=[('interactive', 1, None), ('bulk', 1, None)],
+            workers=1)
+        requests = [dispatcher.broadcast('src', 'bulk1')]
+        self.transport.started.wait(5)
+        requests.append(dispatcher.broadcast('src', 'bulk2'))
+        requests.append(dispatcher.notify('a@a.aa', 'src', 'alert'))
+        self.assertEqual(dispatcher.stats()['bulk']['queued'], 1)
+        self.transport.release.set()
+        self.assertEqual([request.get_result() for request in requests],
+                         [True, True, True])
+        dispatcher.close()
+        self.assertEqual(self.messages(), ['bulk1', 'alert', 'bulk2'])
+        stats = dispatcher.stats()
+        self.assertEqual((stats['bulk']['sent'],
+                          stats['interactive']['sent']), (2, 1))
+        self.assert_(stats['bulk']['wait_max'] >=
+                     stats['interactive']['wait_max'])
+
+    def test_lane_limits(self):
+        # a rate limited lane still sends everything, errors are kept
+        self.transport.release.set()
+        self.transport.codes = [404, 200]
+        dispatcher = boxcargae.PriorityDispatcher(
+            self.boxcar,
+            lanes=[('interactive', 2, None),
+                   ('bulk', 1, boxcargae.TokenBucket(100, 1))])
+        requests = [dispatcher.notify('a@a.aa', 'src', 'm%d' % i,
+                                      lane='bulk') for i in range(3)]
+        self.assertRaises(boxcargae.BoxcarException,
+                          requests[0].get_result)
+        self.assertEqual(requests[0].wait().status_code, 404)
+        dispatcher.close()
+        self.assertEqual(self.messages(), ['m0', 'm1', 'm2'])
+        self.assert_(requests[2].done())
+        self.assertRaises(boxcargae.BoxcarException, dispatcher.notify,
+                          'a@a.aa', 'src', 'late')
+        self.assertRaises(boxcargae.BoxcarException,
+                          boxcargae.PriorityDispatcher(self.boxcar).notify,
+                          'a@a.aa', 'src', 'm', lane='missing')
+
+    def test_unexpected_error(self):
+        # an error other than BoxcarException reaches the caller
+        class Broken(object):
+            def before_request(self, task, size):
+                raise ValueError('broken observer')
+        self.transport.release.set()
+        self.boxcar.add_observer(Broken())
+        dispatcher = boxcargae.PriorityDispatcher(
+            self.boxcar, lanes=[('interactive', 1, None)], workers=1)
+        requests = [dispatcher.notify('a@a.aa', 'src', 'm%d' % i)
+                    for i in range(2)]
+        self.assertRaises(ValueError, requests[0].get_result)
+        self.assert_(isinstance(requests[1].wait(2), ValueError))
+        dispatcher.close()
+        self.assertEqual(dispatcher.stats()['interactive']['active'], 0)
+
+
+class TestBoxcarGAEResults(unittest.TestCase):
+    """ SendResult / ResultSet cases class """
+    def setUp(self):
+        self.transport = StatusTransport(200, 401, 503, 200, 403)
+        self.boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxx@xxxxx.xxx',
+                           transport=self.transport)
+        self.emails = ['%s@a.aa' % c for c in 'abcde']
+
+    def test_compact(self):
+        # the outcomes are summarized without exceptions
+        results = self.boxcar.notify_many(self.emails, 'src', 'message',
+                                          window=2, compact=True)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results.counts(), {200: 2, 401: 1, 503: 1, 403: 1})
+        self.assertEqual(results.categories(),
+                         {'ok': 2, 'unauthorized': 1, 'server': 1,
+                          'throttled': 1})
+        self.assert_(results[0])
+        self.assertEqual(results[1].email_hash,
+                         self.boxcar._md5_email('b@a.aa'))
+        self.assertEqual([result.status_code
+                          for result in results.failures()], [401, 503, 403])
+        self.assertEqual([result.status_code
+                          for result in results.retryable()], [503, 403])
+        self.assert_(results.latency_percentile(50) >= 0)
+
+    def test_compact_errors(self):
+        # transport errors and an open circuit are recorded too
+        self.boxcar._transport = TimeoutTransport(200)
+        results = self.boxcar.notify_many(self.emails[:2], 'src', 'message',
+                                          compact=True)
+        self.assertEqual(results.counts(), {None: 2})
+        self.assertEqual(len(results.retryable()), 2)
+        self.boxcar._breaker = boxcargae.CircuitBreaker(failure_threshold=1)
+        self.boxcar._breaker.record(None)
+        results = self.boxcar.notify_many(self.emails[:2], 'src', 'message',
+                                          compact=True)
+        self.assertEqual(results.categories(), {'circuit_open': 2})
+
+    def test_no_raise(self):
+        # notify returns a SendResult, exceptions carry the category
+        try:
+            self.boxcar.notify('a@a.aa', 'src', 'message', message_id=1)
+            self.boxcar.notify('a@a.aa', 'src', 'message', message_id=1)
+            self.fail()
+        except boxcargae.BoxcarException, e:
+            self.assertEqual((e.status_code, e.category),
+                             (401, 'unauthorized'))
+        boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                                     'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                                     'xxxxxxxxx@xxxxx.xxx',
+                                     transport=self.transport,
+                                     dedup=boxcargae.Deduplicator(),
+                                     raise_errors=False)
+        result = boxcar.broadcast('src', 'message')
+        self.assertEqual((result.status_code, result.category,
+                          result.email_hash), (503, 'server', None))
+        self.assertEqual(boxcar.notify('a@a.aa', 'src', 'message',
+                                       message_id=2).category, 'ok')
+        result = boxcar.notify('a@a.aa', 'src', 'message', message_id=2)
+        self.assertEqual((result.status_code, result.category),
+                         (401, 'duplicate'))
+        self.assertFalse(result)
+
+
+class TestBoxcarGAERegistry(unittest.TestCase):
+    """ ClientRegistry cases class """
+    def setUp(self):
+        self.transport = StatusTransport(200)
+        self.limiter = boxcargae.TokenBucket(1000)
+        self.registry = boxcargae.ClientRegistry(transport=self.transport,
+                                                 rate_limiter=self.limiter)
+
+    def test_shared(self):
+        # the clients of every provider share the pools and the stats
+        first = self.registry.register('key1', 'secret1', 'icon1')
+        second = self.registry.register('key2', 'secret2', 'icon2',
+                                        rate_limiter=None)
+        self.assert_(self.registry.get('key1') is first)
+        self.assertEqual(sorted(self.registry.keys()), ['key1', 'key2'])
+        self.assert_(first._transport is second._transport)
+        self.assert_(first._rate_limiter is self.limiter)
+        self.assert_(second._rate_limiter is None)
+        first.notify('a@a.aa', 'src', 'message')
+        second.broadcast('src', 'message')
+        stats = self.registry.stats.as_dict()
+        self.assertEqual((stats['notifications']['requests'],
+                          stats['notifications/broadcast']['requests']),
+                         (1, 1))
+        self.assertRaises(boxcargae.BoxcarException, self.registry.get,
+                          'key3')
+        # transports without a pool have nothing to warm
+        self.assertEqual(self.registry.warm_up(), 0)
+        self.assert_(boxcargae.default_registry() is
+                     boxcargae.default_registry())
+
+
+class TestBoxcarGAEAsync(unittest.TestCase):
+    """ AsyncBoxcarApi cases class """
+    def setUp(self):
+        self.transport = StatusTransport(200, 404, 500, 200)
+        self.boxcar = boxcargae.AsyncBoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxx@xxxxx.xxx',
+                           max_in_flight=2,
+                           transport=self.transport,
+                           dedup=boxcargae.Deduplicator())
+
+    def test_futures(self):
+        # calls return futures, errors are raised by get_result
+        notify = self.boxcar.notify_async('a@a.aa', 'test_async', 'message',
+                                          message_id=1)
+        invite = self.boxcar.invite_async('b@b.bb')
+        broadcast = self.boxcar.broadcast_async('test_async', 'message')
+        self.assert_(notify.done())
+        self.assertEqual(notify.get_result(), True)
+        try:
+            invite.get_result()
+            self.fail()
+        except boxcargae.BoxcarException, e:
+            self.assertEqual(e.status_code, 404)
+            self.assert_('User not found' in e.msg)
+        self.assertEqual(broadcast.wait().status_code, 500)
+        self.boxcar.wait_all()
+        # the id was marked as sent by the future
+        duplicate = self.boxcar.notify_async('a@a.aa', 'test_async',
+                                             'message', message_id=1)
+        self.assertEqual(duplicate.wait().status_code, 401)
+        self.assertEqual(len(self.transport.payloads), 3)
+
+    def test_timeout(self):
+        # the timeout is the deadline of the request
+        trace = TraceTracker()
+        self.boxcar._transport = Mock('transport', tracker=None)
+        self.boxcar._transport.fetch_async = Mock('fetch_async',
+                                                  returns=RPC(200),
+                                                  tracker=trace)
+        future = self.boxcar.broadcast_async('test_async', 'message',
+                                             timeout=2.5)
+        self.boxcar.wait_all()
+        self.assertEqual(future.get_result(), True)
+        assert_same_trace(trace,
+            "Called fetch_async(\n"
+            "    'http://boxcar.io/devices/providers/xxxxxxxxxxxxxxxxxxxx/notifications/broadcast',\n"
+            "    '...',\n"
+            "    {'User-Agent': 'Boxcar_Client'},\n"
+            "    2.5)\n")
+
+
+class TestBoxcarGAEOutbox(unittest.TestCase):
+    """ Outbox cases class """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'outbox.db')
+        self.transport = StatusTransport(200, 500, 400, 200)
+        self.boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxx@xxxxx.xxx',
+                           transport=self.transport)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_send_replay(self):
+        # only the retryable failure is left for replay
+        outbox = boxcargae.Outbox(self.path, commit_size=2)
+        results = list(outbox.send(self.boxcar, [
+            ('a@a.aa', 'test_outbox', 'one'),
+            {'email': 'b@b.bb', 'name': 'test_outbox', 'message': 'two',
+             'message_id': 2},
+            ('c@c.cc', 'test_outbox', 'three')]))
+        self.assertEqual([r is True for (n, r) in results],
+                         [True, False, False])
+        self.assertEqual(results[1][0]['message'], 'two')
+        self.assertEqual(outbox.pending(), 1)
+        outbox.close()
+        # a duplicate id on replay means the first send went out
+        self.transport.codes = [401]
+        outbox = boxcargae.Outbox(self.path)
+        replayed = list(outbox.replay(self.boxcar))
+        self.assertEqual([n['email'] for (n, r) in replayed], ['b@b.bb'])
+        self.assertEqual(outbox.pending(), 0)
+        outbox.close()
+
+    def test_crash(self):
+        # records logged but never acknowledged are replayed
+        outbox = boxcargae.Outbox(self.path, commit_size=10)
+        outbox._acknowledge = lambda acks: None
+        stream = outbox.send(self.boxcar, [('a@a.aa', 'test_outbox', 'one'),
+                                           ('b@b.bb', 'test_outbox', 'two')])
+        stream.next()
+        del stream
+        self.assertEqual(outbox.pending(), 2)
+        del outbox._acknowledge
+        self.transport.codes = [200]
+        self.assertEqual(len(list(outbox.replay(self.boxcar))), 2)
+        self.assertEqual(outbox.pending(), 0)
+        outbox.close()
+
+    def test_stop_early(self):
+        # closing the stream acknowledges the results seen
+        outbox = boxcargae.Outbox(self.path, commit_size=10)
+        stream = outbox.send(self.boxcar, [('a@a.aa', 'test_outbox', 'one'),
+                                           ('b@b.bb', 'test_outbox', 'two')],
+                             window=1)
+        self.assertEqual(stream.next()[1], True)
+        stream.close()
+        self.assertEqual(outbox.pending(), 1)
+        self.assertEqual([values['email'] for (values, result)
+                          in outbox.replay(self.boxcar)], ['b@b.bb'])
+        outbox.close()
+
+
+class TestBoxcarGAECommand(unittest.TestCase):
+    """ command line cases class """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        restore()
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        open(path, 'wb').write(text)
+        return path
+
+    def test_read_csv(self):
+        # empty columns are left out, defaults fill the gaps
+        path = self.write('in.csv', 'email,message,message_id,extra\n'
+                                    'a@a.aa,one,1,x\n'
+                                    'b@b.bb,two,,x\n'
+                                    'c@c.cc,three,3,x\n')
+        self.assertEqual(list(boxcargae.read_notifications(
+                             path, {'name': 'test_cli'}, 0, 2))[1],
+                         {'email': 'b@b.bb', 'message': 'two',
+                          'name': 'test_cli'})
+
+    def test_read_shards(self):
+        # byte ranges give every record to one shard, in order
+        lines = ['{"email": "%d@a.aa", "name": "n", "message": "%s"}\n' %
+                 (i, 'x' * (i % 7)) for i in range(50)]
+        for (name, text) in [('in.jsonl', ''.join(lines)),
+                             ('in.csv', 'email,message\n' +
+                              ''.join('%d@a.aa,%s\n' % (i, 'x' * (i % 7 + 1))
+                                      for i in range(50)))]:
+            path = self.write(name, text)
+            for shards in [1, 3, 8, 64]:
+                emails = [n['email'] for shard in range(shards)
+                          for n in boxcargae.read_notifications(
+                              path, None, shard, shards)]
+                self.assertEqual(emails,
+                                 ['%d@a.aa' % i for i in range(50)])
+
+    def test_read_jsonl(self):
+        path = self.write('in.jsonl', '{"email": "a@a.aa", "name": "n", '
+                                      '"message": "one"}\n\n'
+                                      '{"email": "b@b.bb", "name": "n", '
+                                      '"message": "two"}\n')
+        self.assertEqual([n['email'] for n in
+                          boxcargae.read_notifications(path)],
+                         ['a@a.aa', 'b@b.bb'])
+
+    def test_send_shard(self):
+        # a shard writes one result line per notification
+        path = self.write('in.jsonl', '{"email": "a@a.aa", "name": "n", '
+                                      '"message": "one"}\n')
+        result_path = os.path.join(self.directory, 'shard-0.jsonl')
+        mock('boxcargae.HttpTransport', returns=StatusTransport(404),
+             tracker=None)
+        stats = boxcargae._send_shard(({'key': 'k', 'secret': 's',
+                                        'icon': None, 'window': None,
+                                        'endpoint': None, 'defaults': {}},
+                                       path, 0, 1, result_path))
+        self.assertEqual(stats['statuses'], {'404': 1})
+        self.assertEqual(boxcargae.json.loads(open(result_path).read()),
+                         {'email': 'a@a.aa', 'message_id': None,
+                          'status': 404,
+                          'error': 'Unknown response: 404'})
+
+    def test_send_incomplete(self):
+        # a record missing a field gets an error line, the rest are sent
+        path = self.write('in.csv', 'email,name,message\n'
+                                    'a@a.aa,n,one\n'
+                                    'b@b.bb,n,\n'
+                                    'c@c.cc,n,three\n')
+        result_path = os.path.join(self.directory, 'shard-0.jsonl')
+        transport = StatusTransport(200)
+        mock('boxcargae.HttpTransport', returns=transport, tracker=None)
+        stats = boxcargae._send_shard(({'key': 'k', 'secret': 's',
+                                        'icon': None, 'window': None,
+                                        'endpoint': None, 'defaults': {}},
+                                       path, 0, 1, result_path))
+        self.assertEqual(stats['statuses'], {'200': 2, 'error': 1})
+        self.assertEqual(len(transport.payloads), 2)
+        lines = [boxcargae.json.loads(line) for line in open(result_path)]
+        self.assertEqual([(line['email'], line['status'])
+                          for line in lines],
+                         [('a@a.aa', 200), ('b@b.bb', None),
+                          ('c@c.cc', 200)])
+        self.assert_(lines[1]['error'].startswith('Invalid notification'))
+
+
+class TestBoxcarGAESubscribers(unittest.TestCase):
+    """ SubscriberCache cases class """
+    def setUp(self):
+        self.transport = StatusTransport(200)
+        self.subscribers = boxcargae.SubscriberCache()
+        self.boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxx@xxxxx.xxx',
+                           transport=self.transport,
+                           subscribers=self.subscribers)
+
+    def test_invite(self):
+        # invited and unknown users are not invited again
+        self.transport.codes = [200, 404, 200]
+        self.assertEqual(self.boxcar.invite('a@a.aa'), True)
+        self.assertRaises(boxcargae.BoxcarException,
+                          self.boxcar.invite, 'b@b.bb')
+        self.assertEqual(self.boxcar.invite('a@a.aa'), True)
+        try:
+            self.boxcar.invite('b@b.bb')
+            self.fail()
+        except boxcargae.BoxcarException, e:
+            self.assertEqual(e.status_code, 404)
+        self.assertEqual(len(self.transport.payloads), 2)
+        # an unknown user is not notified either
+        self.assertRaises(boxcargae.BoxcarException, self.boxcar.notify,
+                          'b@b.bb', 'test_subscribers', 'message')
+        self.assertEqual(len(self.transport.payloads), 2)
+
+    def test_notify(self):
+        # a 401 without message_id marks the user as not subscribed
+        self.transport.codes = [401]
+        self.assertRaises(boxcargae.BoxcarException, self.boxcar.notify,
+                          'a@a.aa', 'test_subscribers', 'message',
+                          message_id=1)
+        self.assertRaises(boxcargae.BoxcarException, self.boxcar.notify,
+                          'a@a.aa', 'test_subscribers', 'message')
+        self.assertRaises(boxcargae.BoxcarException, self.boxcar.notify,
+                          'a@a.aa', 'test_subscribers', 'message')
+        self.assertEqual(len(self.transport.payloads), 2)
+        # invite is still tried
+        self.transport.codes = [200]
+        self.assertEqual(self.boxcar.invite('a@a.aa'), True)
+        self.assertEqual(len(self.transport.payloads), 3)
+
+    def test_shared(self):
+        # a state found in the shared tier is copied to the local one
+        shared = boxcargae.LocalStore()
+        shared.set('hash', boxcargae.SubscriberCache.UNKNOWN)
+        local = boxcargae.LocalStore()
+        cache = boxcargae.SubscriberCache(local, shared,
+                                          ttls={'unknown': 5})
+        self.assertEqual(cache.get('hash'), 'unknown')
+        self.assertEqual(local.get('hash'), 'unknown')
+        self.assertEqual(cache.get('other'), None)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_unsubscribed_local(self):
+        # a 401 on notify is not written to the shared tier
+        shared = boxcargae.LocalStore()
+        self.boxcar._subscribers = boxcargae.SubscriberCache(shared=shared)
+        self.transport.codes = [401]
+        self.assertRaises(boxcargae.BoxcarException, self.boxcar.notify,
+                          'a@a.aa', 'test_subscribers', 'message')
+        email_hash = self.boxcar._md5_email('a@a.aa')
+        self.assertEqual(self.boxcar._subscribers.get(email_hash),
+                         'unsubscribed')
+        self.assertEqual(shared.get(email_hash), None)
+
+
+class TestBoxcarFake(unittest.TestCase):
+    """ boxcarfake cases class """
+    def setUp(self):
+        self.transport = boxcarfake.FakeTransport(
+            endpoint_statuses={'notifications/subscribe': {404: 1}}, seed=1)
+        self.boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxx@xxxxx.xxx',
+                           transport=self.transport)
+
+    def test_statuses(self):
+        # endpoint mixes, scripted outcomes and the timeline
+        self.assertRaises(boxcargae.BoxcarException, self.boxcar.invite,
+                          'a@a.aa')
+        self.assertEqual(self.boxcar.notify('a@a.aa', 'src', 'message'), True)
+        self.transport.script('notifications', 500, 'reset')
+        self.assertRaises(boxcargae.BoxcarException, self.boxcar.notify,
+                          'a@a.aa', 'src', 'message')
+        self.assertRaises(boxcargae.BoxcarTransportError, self.boxcar.notify,
+                          'a@a.aa', 'src', 'message')
+        self.assertEqual([(entry['task'], entry['status'], entry['fault'])
+                          for entry in self.transport.timeline],
+                         [('notifications/subscribe', 404, None),
+                          ('notifications', 200, None),
+                          ('notifications', 500, None),
+                          ('notifications', None, 'reset')])
+        summary = self.transport.summary()
+        self.assertEqual((summary['notifications']['statuses'],
+                          summary['notifications']['faults']),
+                         ({200: 1, 500: 1}, {'reset': 1}))
+
+    def test_latency(self):
+        # a latency over the deadline times out at the deadline
+        transport = boxcarfake.FakeTransport(
+            latency=boxcarfake.uniform(0.05, 0.06))
+        self.boxcar._transport = transport
+        self.assertRaises(boxcargae.BoxcarTransportError,
+                          self.boxcar._do_notify, 'notifications', 'a@a.aa',
+                          'src', 'message', deadline=0.01)
+        self.assertEqual(self.boxcar._do_notify('notifications', 'a@a.aa',
+                                                'src', 'message',
+                                                deadline=1.0), True)
+        (timeout, sent) = transport.timeline
+        self.assertEqual((timeout['fault'], sent['status']), ('timeout', 200))
+        self.assert_(timeout['end'] - timeout['start'] < 0.05)
+        self.assert_(sent['end'] - sent['start'] >= 0.05)
+
+    def test_concurrency(self):
+        # requests over the limit are rejected at once
+        transport = boxcarfake.FakeTransport(latency=0.05, max_concurrency=2)
+        self.boxcar._transport = transport
+        results = self.boxcar.notify_many(['%d@a.aa' % i for i in range(4)],
+                                          'src', 'message', window=4,
+                                          compact=True)
+        self.assertEqual(results.counts(), {200: 2, 503: 2})
+        self.assertEqual(transport.summary()['notifications']
+                         ['max_in_flight'], 2)
+
+    def test_urlfetch(self):
+        # the fake urlfetch api behind UrlfetchTransport
+        urlfetch = boxcarfake.FakeUrlfetch(statuses={200: 1})
+        urlfetch.install()
+        try:
+            boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                               'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                               'xxxxxxxxx@xxxxx.xxx',
+                               transport=boxcargae.UrlfetchTransport())
+            self.assertEqual(boxcar.broadcast('src', 'message'), True)
+            urlfetch.script('notifications', 'timeout')
+            urlfetch.DEFAULT_DEADLINE = 0.01
+            self.assertEqual([result is True for (email, result) in
+                              boxcar.notify_many(['a@a.aa', 'b@b.bb'],
+                                                 'src', 'message')],
+                             [False, True])
+        finally:
+            urlfetch.uninstall()
+        self.assert_(boxcargae.urlfetch is google.appengine.api.urlfetch)
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ boxcar stub answering 200 over keep-alive connections """
+    protocol_version = "HTTP/1.1"
+    connections = set()
+
+    def do_POST(self):
+        """ record the connection and answer 200 """
+        self.rfile.read(int(self.headers["Content-Length"]))
+        KeepAliveHandler.connections.add(self.client_address)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        """ be quiet """
+
+
+class TestHttpTransport(unittest.TestCase):
+    """ HttpTransport cases class """
+    def setUp(self):
+        KeepAliveHandler.connections = set()
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0),
+                                                KeepAliveHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.transport = boxcargae.HttpTransport(max_connections=2)
+        self.boxcar = boxcargae.BoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxx@xxxxx.xxx',
+                           transport=self.transport,
+                           endpoint='http://127.0.0.1:%d/devices/providers/' %
+                                    self.server.server_address[1])
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        # three sends share one connection
+        for message_id in range(3):
+            self.assertEqual(self.boxcar.notify('yyyyyyyy@yyyyy.yyy',
+                                                'test_http',
+                                                'http message',
+                                                message_id=message_id),
+                             True)
+        self.assertEqual(len(KeepAliveHandler.connections), 1)
+
+    def test_bounded_threads(self):
+        # async sends share max_connections worker threads,
+        # one here as the stub serves a connection at a time
+        transport = boxcargae.HttpTransport(max_connections=1)
+        before = threading.activeCount()
+        boxcar = boxcargae.AsyncBoxcarApi('xxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                           'xxxxxxxxx@xxxxx.xxx',
+                           transport=transport,
+                           endpoint=self.boxcar.ENDPOINT)
+        futures = [boxcar.notify_async('yyyyyyyy@yyyyy.yyy', 'test_http',
+                                       'http message') for i in range(5)]
+        self.assertEqual(threading.activeCount() - before, 1)
+        self.assertEqual([future.get_result() for future in futures],
+                         [True] * 5)
+        transport.close()
+
+    def test_warm_up(self):
+        # the warmed connection serves the first request
+        registry = boxcargae.ClientRegistry(transport=self.transport)
+        boxcar = registry.register('xxxxxxxxxxxxxxxxxxxx',
+                                   'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+                                   'xxxxxxxxx@xxxxx.xxx',
+                                   endpoint=self.boxcar.ENDPOINT)
+        self.assertEqual(registry.warm_up(), 1)
+        self.assertEqual(registry.warm_up(), 0)
+        self.assertEqual(boxcar.notify('yyyyyyyy@yyyyy.yyy', 'test_http',
+                                       'http message'), True)
+        self.assertEqual(len(KeepAliveHandler.connections), 1)
+        self.assertEqual(sum(len(conns) for conns
+                             in self.transport._idle.values()), 1)
 
 
 if __name__ == '__main__':